@@ -1,61 +1,83 @@
 import ollama
 import httpx
 import re
-import time
-from loguru import logger
+import asyncio
+
+from module.utils import sleep_backoff, backoff_delay, is_retryable_status, LRUCache, get_module_logger
+
+_JSON_FENCE_RE = re.compile(r'^```json\n')
+_OPTION_KEYS = ('temperature', 'top_k', 'top_p')
+# 未显式指定 keep_alive 时模型常驻 30 分钟，避免两次调用之间模型被卸载、重新加载权重
+_DEFAULT_KEEP_ALIVE = '30m'
 
 
 class OllamaClient():
-    def __init__(self, host, port, timeout=120, **kwargs):
+    def __init__(self, host, port, timeout=120, cache_enabled=True, cache_maxsize=1024, max_concurrent=4, **kwargs):
         self.client = ollama.Client(host=f'http://{host}:{port}', timeout=timeout)
-        self.initial_paras = kwargs
-
-        log_name = 'LLM'
-        logger.add(f"logs/module_{log_name}_{{time:YYYY-MM-DD}}.log",
-               level="INFO",
-               rotation="00:00",
-               filter=lambda record: record["extra"].get("name") == log_name,
-               enqueue=False,
-               buffering=1)
-        self.logger = logger.bind(name=log_name)
-
-    @staticmethod
-    def first_value(*args):
-        for x in args:
-            if x is not None:
-                return x
-        return
-
-    def generate(self, prompt, retry_count=3, retry_delay=3, **kwargs):
-        # 初始化 options 字典
-        options = {}
-        for para in ['temperature', 'top_k', 'top_p']:
-            options[para] = self.first_value(kwargs.get(para), self.initial_paras.get(para), 0)
-
-        #options['num_ctx'] = self.first_value(kwargs.get('num_ctx'), self.initial_paras.get('num_ctx'), 2048)
+        self.aclient = ollama.AsyncClient(host=f'http://{host}:{port}', timeout=timeout)
+        # agenerate 的并发上限，与服务端可同时解码的请求数匹配，超出部分在本地排队；
+        # agenerate 统一经 utils.run_async 在进程共用的事件循环中执行，因此是进程级上限
+        self._sem = asyncio.Semaphore(max_concurrent)
+        # 值为 None 的参数视为未设置，调用时由 generate 的参数或默认值补齐
+        self.initial_paras = {k: v for k, v in kwargs.items() if v is not None}
+        # format='json' 时 ollama 保证返回严格 JSON，调用方可直接解析而无需 format_LLM_result 清洗
+        self.json_mode = self.initial_paras.get('format') == 'json'
+        # 相同 (model, system, options, prompt) 的请求直接返回缓存结果；只缓存 temperature=0 的回答，
+        # generate/agenerate 只读缓存，回答由调用方确认可用后通过 cache_response 写入
+        self._cache = LRUCache(maxsize=cache_maxsize) if cache_enabled else None
+
+        self.logger = get_module_logger('LLM')
+
+    def _build_request(self, **kwargs):
+        # 调用参数覆盖初始化参数（None 视为未设置）
+        merged = {**self.initial_paras, **{k: v for k, v in kwargs.items() if v is not None}}
+        options = {k: merged.get(k, 0) for k in _OPTION_KEYS}
+
+        #options['num_ctx'] = merged.get('num_ctx', 2048)
 
         # 获取其他参数
-        model = self.first_value(kwargs.get('model'), self.initial_paras.get('model'))
-        system = self.first_value(kwargs.get('system'), self.initial_paras.get('system'))
-        _format = self.first_value(kwargs.get('format'), self.initial_paras.get('format'))
-        keep_alive = self.first_value(kwargs.get('keep_alive'), self.initial_paras.get('keep_alive'))
+        return dict(
+            model=merged.get('model'),
+            system=merged.get('system'),
+            format=merged.get('format'),
+            keep_alive=merged.get('keep_alive', _DEFAULT_KEEP_ALIVE),
+            options=options,
+        )
+
+    def _cache_key(self, prompt, request):
+        """可缓存时返回缓存键；未开启缓存或 temperature > 0 时返回 None"""
+        if self._cache is None or request['options']['temperature'] != 0:
+            return None
+        return LRUCache.make_key(request['model'], request['system'], request['format'], request['options'], prompt)
+
+    def cache_response(self, prompt, response, **kwargs):
+        """调用方确认回答可用（如 JSON 解析成功）后写入缓存，kwargs 与调用 generate 时相同"""
+        cache_key = self._cache_key(prompt, self._build_request(**kwargs))
+        if cache_key is not None and response:
+            self._cache.set(cache_key, response)
+
+    def generate(self, prompt, use_cache=True, retry_count=3, retry_delay=3, **kwargs):
+        request = self._build_request(**kwargs)
+        cache_key = self._cache_key(prompt, request) if use_cache else None
+        if cache_key is not None:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                return cached
 
         # 尝试重试逻辑
         for attempt in range(retry_count):
             try:
                 # 调用模型生成
-                response = self.client.generate(
-                    model=model,
-                    prompt=prompt,
-                    format=_format,
-                    keep_alive=keep_alive,
-                    options=options,
-                    system=system
-                )
+                response = self.client.generate(prompt=prompt, **request)
                 return response['response']  # 返回生成的响应
             except httpx.ReadTimeout:
                 # 如果是超时错误，打印警告并等待重试
                 self.logger.warning(f'调用大模型返回结果超时，尝试第 {attempt + 1} 次重试')
+            except ollama.ResponseError as e:
+                # 4xx（429 除外）属于请求错误，不再重试
+                self.logger.error(f'大模型生成结果失败，状态码 {e.status_code}: {e.error}')
+                if not is_retryable_status(e.status_code):
+                    break
             except Exception as e:
                 # 其他异常时，记录错误并继续尝试
                 self.logger.error('大模型生成结果失败')
@@ -63,14 +85,44 @@ class OllamaClient():
 
             # 如果失败，等待一段时间后再重试
             if attempt < retry_count - 1:
-                time.sleep(retry_delay)  # 延迟一段时间再重试
+                sleep_backoff(attempt, retry_delay)  # 指数退避后再重试
 
         # 所有尝试都失败时返回空字符串
         return ''
 
+    async def agenerate(self, prompt, use_cache=True, retry_count=3, retry_delay=3, **kwargs):
+        """generate 的协程版本，多段 prompt 可通过 asyncio.gather 并发调用；需通过 utils.run_async 执行"""
+        request = self._build_request(**kwargs)
+        cache_key = self._cache_key(prompt, request) if use_cache else None
+        if cache_key is not None:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        for attempt in range(retry_count):
+            try:
+                async with self._sem:
+                    response = await self.aclient.generate(prompt=prompt, **request)
+                return response['response']
+            except httpx.ReadTimeout:
+                self.logger.warning(f'调用大模型返回结果超时，尝试第 {attempt + 1} 次重试')
+            except ollama.ResponseError as e:
+                # 4xx（429 除外）属于请求错误，不再重试
+                self.logger.error(f'大模型生成结果失败，状态码 {e.status_code}: {e.error}')
+                if not is_retryable_status(e.status_code):
+                    break
+            except Exception as e:
+                self.logger.error('大模型生成结果失败')
+                self.logger.exception(e)
+
+            if attempt < retry_count - 1:
+                await asyncio.sleep(backoff_delay(attempt, retry_delay))
+
+        return ''
+
     @ staticmethod
     def format_LLM_result(result):
-        result = re.sub('^```json\n','',result)
+        result = _JSON_FENCE_RE.sub('', result)
         result = result.strip('`\n')
         result = result.replace('.%','%')
         return result
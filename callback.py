@@ -2,21 +2,19 @@
 """
 回调模块：处理结果回调逻辑
 """
-import time
-import requests
-from loguru import logger
-from typing import Optional
+import httpx
 
-log_name = 'callback'
-logger.add(
-    f"logs/module_{log_name}_{{time:YYYY-MM-DD}}.log",
-    level="INFO",
-    rotation="00:00",
-    filter=lambda record: record["extra"].get("name") == log_name,
-    enqueue=False,
-    buffering=1
-)
-callback_logger = logger.bind(name=log_name)
+from module.utils import sleep_backoff, is_retryable_status, get_module_logger, json_dumps
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2（pip install httpx[http2]）
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+_LIMITS = httpx.Limits(max_keepalive_connections=8, max_connections=16)
+_JSON_HEADERS = {'Content-Type': 'application/json; charset=utf-8'}
 
 
 class CallbackClient:
@@ -33,48 +31,46 @@ class CallbackClient:
         self.callback_port = callback_port
         self.final_result_url = f'http://{callback_host}:{callback_port}{final_result_path}'
         self.ocr_result_url = f'http://{callback_host}:{callback_port}{ocr_result_path}'
+        # 在实例化时注册日志 sink：main.py 导入模块后会 logger.remove()，导入期注册的 sink 会被清掉
+        self.logger = get_module_logger('callback')
+        
+        # 回调地址固定，复用连接池避免每次回调重新建立TCP连接；
+        # 安装了 h2 且服务端为 https 时可协商 HTTP/2 多路复用
+        self.client = httpx.Client(http2=_HTTP2, timeout=_TIMEOUT, limits=_LIMITS)
     
-    def send_error_result(self, task_no: str, error_msg: str, retry_count: int = 3, retry_delay: int = 3):
-        """发送错误结果"""
-        error_data = {"taskNo": task_no, "errorMsg": error_msg}
+    def close(self):
+        """关闭连接池"""
+        self.client.close()
+    
+    def _post(self, url: str, data: dict, task_no: str, label: str, retry_count: int, retry_delay: int):
+        """发送回调请求，失败时指数退避重试；4xx（429 除外）不重试"""
         try:
-            for _ in range(retry_count):
-                resp = requests.post(self.final_result_url, json=error_data)
+            # 只序列化一次，重试时复用
+            body = json_dumps(data).encode('utf-8')
+            for attempt in range(retry_count):
+                resp = self.client.post(url, content=body, headers=_JSON_HEADERS)
                 if resp.status_code == 200:
-                    callback_logger.info(f'{task_no}：错误消息已返回')
+                    self.logger.info(f'{task_no}：{label}已返回')
+                    break
+                if not is_retryable_status(resp.status_code):
+                    self.logger.error(f'{task_no}：{label}返回失败，状态码 {resp.status_code}，不再重试')
                     break
-                else:
-                    callback_logger.warning(f'{task_no}：错误消息返回失败，重试中...')
-                    time.sleep(retry_delay)
+                self.logger.warning(f'{task_no}：{label}返回失败，重试中...')
+                if attempt < retry_count - 1:
+                    sleep_backoff(attempt, retry_delay)
         except Exception as e:
-            callback_logger.error(f'{task_no}：错误消息返回失败: {e}')
+            self.logger.error(f'{task_no}：{label}返回失败: {e}')
+    
+    def send_error_result(self, task_no: str, error_msg: str, retry_count: int = 3, retry_delay: int = 3):
+        """发送错误结果"""
+        error_data = {"taskNo": task_no, "errorMsg": error_msg}
+        self._post(self.final_result_url, error_data, task_no, '错误消息', retry_count, retry_delay)
     
     def send_normal_result(self, task_no: str, result: str, retry_count: int = 3, retry_delay: int = 3):
         """发送正常结果"""
         data = {"taskNo": task_no, "result": result}
-        try:
-            for _ in range(retry_count):
-                resp = requests.post(self.final_result_url, json=data)
-                if resp.status_code == 200:
-                    callback_logger.info(f'{task_no}：【大模型提取要素结果】消息已返回')
-                    break
-                else:
-                    callback_logger.warning(f'{task_no}：【大模型提取要素结果】消息返回失败，重试中...')
-                    time.sleep(retry_delay)
-        except Exception as e:
-            callback_logger.error(f'{task_no}：【大模型提取要素结果】消息返回失败: {e}')
+        self._post(self.final_result_url, data, task_no, '【大模型提取要素结果】消息', retry_count, retry_delay)
     
     def send_ocr_result(self, task_no: str, ocr_data: dict, retry_count: int = 3, retry_delay: int = 3):
         """发送OCR结果"""
-        try:
-            for _ in range(retry_count):
-                resp = requests.post(self.ocr_result_url, json=ocr_data)
-                if resp.status_code == 200:
-                    callback_logger.info(f'{task_no}：【OCR文件结果】消息已返回')
-                    break
-                else:
-                    callback_logger.warning(f'{task_no}：【OCR文件结果】消息返回失败，重试中...')
-                    time.sleep(retry_delay)
-        except Exception as e:
-            callback_logger.error(f'{task_no}：【OCR文件结果】消息返回失败: {e}')
-
+        self._post(self.ocr_result_url, ocr_data, task_no, '【OCR文件结果】消息', retry_count, retry_delay)
@@ -21,6 +21,7 @@ class ConfigLoader:
         self.env = env
         self.config_path = Path(f'./config/{env}.toml')
         self._config: Dict[str, Any] = {}
+        self._flat: Dict[str, Any] = {}
         self.load_config()
     
     def load_config(self):
@@ -28,20 +29,24 @@ class ConfigLoader:
         if not self.config_path.exists():
             raise FileNotFoundError(f"配置文件不存在: {self.config_path}")
         self._config = toml.load(self.config_path)
+        self._flat = self._flatten(self._config)
         logger.info(f"已加载配置文件: {self.config_path}")
     
+    @staticmethod
+    def _flatten(config: Dict[str, Any], prefix: str = '') -> Dict[str, Any]:
+        """将嵌套配置展开为 {点号分隔key: 值}，中间层的dict也一并保留"""
+        flat: Dict[str, Any] = {}
+        for k, v in config.items():
+            key = f'{prefix}.{k}' if prefix else k
+            flat[key] = v
+            if isinstance(v, dict):
+                flat.update(ConfigLoader._flatten(v, key))
+        return flat
+    
     def get(self, key: str, default: Any = None) -> Any:
         """获取配置值，支持点号分隔的嵌套key，如 'static.common-file-center.host'"""
-        keys = key.split('.')
-        value = self._config
-        for k in keys:
-            if isinstance(value, dict):
-                value = value.get(k)
-                if value is None:
-                    return default
-            else:
-                return default
-        return value
+        value = self._flat.get(key)
+        return default if value is None else value
     
     def get_file_center_config(self) -> Dict[str, Any]:
         """获取文件中心配置"""
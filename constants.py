@@ -0,0 +1,10 @@
+# module/constants.py
+"""
+常量模块：文件中心与服务入口共用的文件类型白名单
+"""
+
+# 压缩包后缀
+COMPRESS_EXTS: frozenset = frozenset({'zip', 'rar'})
+
+# 允许从文件中心获取的文件后缀（含压缩包）
+SUPPORTED_EXTS: frozenset = frozenset({'pdf', 'jpg', 'jpeg', 'png', 'docx', 'txt'}) | COMPRESS_EXTS
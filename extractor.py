@@ -2,19 +2,23 @@
 """
 要素提取模块：处理PDF OCR -> Prompt -> LLM -> 返回的核心业务逻辑
 """
-import json
+import asyncio
 import re
-import pandas as pd
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Any, Optional, Tuple, Union
 from loguru import logger
 
-from module.utils import convert_to_date, convert_to_number, extract_valid_id_numbers
+from module.utils import convert_to_date, convert_to_number, extract_valid_id_numbers, json_loads, json_dumps, LRUCache, run_async
 from module.Prompt import contract_element_extract_prompt_pattern
 from module.ocr import OcrTool, OcrError
 from module.llm_openai import OpenAICompatClient
 from module.file_center import FileCenter
 
+_CJK_RE = re.compile(r'[\u4e00-\u9fff]+')
+_NL_RE = re.compile(r'\n+')
+
 
 class ElementExtractor:
     """合同要素提取器：封装完整的提取流程"""
@@ -42,6 +46,8 @@ class ElementExtractor:
         self.tokenizer = tokenizer
         self.ctx_limit = ctx_limit
         self.seal_tool = seal_tool
+        # 同一字段模板在多个任务间复用，schema提示词按模板缓存
+        self._schema_cache = LRUCache(maxsize=256)
     
     def _get_tokens_num(self, text: str) -> int:
         """估算token数量"""
@@ -54,6 +60,11 @@ class ElementExtractor:
     
     def _build_schema_prompt(self, config: List) -> Tuple[str, Dict[str, List[str]], Dict[str, List[str]]]:
         """构建schema提示词"""
+        cache_key = tuple((e.fieldKey, e.fieldKeyType, tuple(e.nearFieldKeys or ())) for e in config)
+        cached = self._schema_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         text_schema = [i.fieldKey for i in config if i.fieldKeyType == '0']
         money_schema = [i.fieldKey for i in config if i.fieldKeyType == '1']
         date_schema = [i.fieldKey for i in config if i.fieldKeyType == '2']
@@ -77,14 +88,39 @@ class ElementExtractor:
                         synonym = '，'.join(synonym_dict[schema])
                         schema_prompt += f'（可能的近义词:{synonym}）'
         
-        return schema_prompt.strip(), schema_dict, synonym_dict
+        result = (schema_prompt.strip(), schema_dict, synonym_dict)
+        self._schema_cache.set(cache_key, result)
+        return result
+    
+    def _recognize_main_bank(self, file_paths: List[Path], task_file_folder: Path) -> str:
+        """
+        印章识别主银行，失败或未识别到时返回空字符串
+        :param file_paths: 已解析为完整路径的任务文件列表
+        """
+        try:
+            seal_input_files = [
+                fp for fp in file_paths if fp.suffix.lower().lstrip(".") in {"pdf", "png", "jpg", "jpeg"}
+            ]
+            
+            all_best: List[str] = []
+            for fp in seal_input_files:
+                seal_out_dir = task_file_folder / "seal_out" / fp.stem
+                seal_out_dir.mkdir(parents=True, exist_ok=True)
+                r = self.seal_tool.extract_from_file(fp, out_dir=seal_out_dir)
+                if r.get("best_bank"):
+                    all_best.append(r["best_bank"])
+            
+            if all_best:
+                cnt = Counter(all_best)
+                return max(cnt.keys(), key=lambda k: (cnt[k], len(k)))
+        except Exception as e:
+            logger.warning(f'Seal 主银行识别失败（跳过）: {e}')
+        return ''
     
     def _extract_prefilled_fields(
         self,
         config: List[Any],
-        doc_text: str,
-        filename_list: List[Path],
-        task_file_folder: Path,
+        main_bank_name: str,
         valid_id_map: Dict[str, str]
     ) -> Dict[str, str]:
         """提取预填充字段（主银行、身份证号等）"""
@@ -93,36 +129,10 @@ class ElementExtractor:
         type4_fields = [e.fieldKey for e in config if e.fieldKeyType == '4']  # 主银行
         type5_fields = [e.fieldKey for e in config if e.fieldKeyType == '5']  # 身份证
         
-        # 主银行识别
-        if type4_fields and self.seal_tool is not None:
-            try:
-                seal_input_files: List[Path] = []
-                for fn in filename_list:
-                    fn_path = Path(fn)
-                    suf = fn_path.suffix.lower().lstrip(".")
-                    if suf in {"pdf", "png", "jpg", "jpeg"}:
-                        if fn_path.is_absolute():
-                            seal_input_files.append(fn_path)
-                        else:
-                            seal_input_files.append(task_file_folder / fn_path)
-                
-                all_best: List[str] = []
-                for fp in seal_input_files:
-                    seal_out_dir = task_file_folder / "seal_out" / fp.stem
-                    seal_out_dir.mkdir(parents=True, exist_ok=True)
-                    r = self.seal_tool.extract_from_file(fp, out_dir=seal_out_dir)
-                    if r.get("best_bank"):
-                        all_best.append(r["best_bank"])
-                
-                if all_best:
-                    from collections import Counter
-                    cnt = Counter(all_best)
-                    main_bank_name = max(cnt.keys(), key=lambda k: (cnt[k], len(k)))
-                    if main_bank_name:
-                        for k in type4_fields:
-                            prefilled[k] = main_bank_name
-            except Exception as e:
-                logger.warning(f'Seal 主银行识别失败（跳过）: {e}')
+        # 主银行
+        if type4_fields and main_bank_name:
+            for k in type4_fields:
+                prefilled[k] = main_bank_name
         
         # 身份证号
         if type5_fields:
@@ -144,13 +154,13 @@ class ElementExtractor:
         task_file_folder: Path,
         task_ocr_txt_folder: Path,
         file_id_name_mapping_dict: Dict[str, str]
-    ) -> str:
+    ) -> Tuple[Dict[str, Any], str]:
         """
         执行完整的提取流程：
         1. 对PDF进行整体OCR
         2. 拼接prompt模板
         3. 调用大模型
-        4. 返回结果
+        4. 返回结果字典及其 JSON 字符串（调用方可直接检查字典，无需再解析 JSON）
         """
         # 1. 字段分组和schema构建
         schema_prompt, schema_dict, synonym_dict = self._build_schema_prompt(config)
@@ -167,23 +177,24 @@ class ElementExtractor:
                 local_filename = file_id_name_mapping_dict[fid]
                 filename_list.append(Path(local_filename))
         
-        # 3. 对PDF进行整体OCR
+        # 文件已经在task_file_folder中，统一解析为完整路径，供OCR和印章识别共用
+        file_paths = [fn if fn.is_absolute() else task_file_folder / fn for fn in filename_list]
+        
+        # 3. 印章识别与OCR互不依赖，主银行识别放到后台线程与OCR并行（两边的 fitz 调用由 FITZ_LOCK 互斥）
+        seal_executor = None
+        seal_future = None
+        if self.seal_tool is not None and any(e.fieldKeyType == '4' for e in config):
+            seal_executor = ThreadPoolExecutor(max_workers=1)
+            seal_future = seal_executor.submit(self._recognize_main_bank, file_paths, task_file_folder)
+        
+        # 对PDF进行整体OCR
         try:
             logger.info(f'{task_no}：开始OCR识别')
-            file_names = [''.join(re.findall(r'[\u4e00-\u9fff]', Path(fn).name)) for fn in filename_list]
+            file_names = [''.join(_CJK_RE.findall(fn.name)) for fn in filename_list]
             file_names = [n for n in file_names if n]
             file_names_str = "，".join(file_names) if file_names else "未检测到有效中文文件名"
             
-            # 执行OCR：文件已经在task_file_folder中，使用完整路径
-            ocr_file_paths = []
-            for fn in filename_list:
-                fn_path = Path(fn)
-                if fn_path.is_absolute():
-                    ocr_file_paths.append(fn_path)
-                else:
-                    ocr_file_paths.append(task_file_folder / fn_path)
-            
-            doc_text, page_text_dict = self.ocr_tool.ocr_files(ocr_file_paths)
+            doc_text, page_text_dict = self.ocr_tool.ocr_files(file_paths)
             doc_text, page_text_dict = self.ocr_tool.remove_duplicate_sentences(doc_text, page_text_dict)
             valid_id_map = extract_valid_id_numbers(doc_text)
             
@@ -191,17 +202,21 @@ class ElementExtractor:
         except OcrError as e:
             logger.error(f'{task_no}：OCR失败: {e}')
             raise
+        finally:
+            # OCR 失败时也要等印章线程结束：它在写 task_file_folder/seal_out，
+            # 调用方随后会清空该目录并交给下一个任务复用
+            if seal_executor is not None:
+                seal_executor.shutdown(wait=True)
         
         if not doc_text:
             raise ValueError('文件OCR内容为空')
         
         # 4. 提取预填充字段
-        prefilled = self._extract_prefilled_fields(
-            config, doc_text, filename_list, task_file_folder, valid_id_map
-        )
+        main_bank_name = seal_future.result() if seal_future is not None else ''
+        prefilled = self._extract_prefilled_fields(config, main_bank_name, valid_id_map)
         
         # 5. 构建完整prompt
-        extra_prompt_text = re.sub('\n+', '\n', f'''
+        extra_prompt_text = _NL_RE.sub('\n', f'''
         ## 补充说明
         {extra_prompt}
         '''.strip()) if extra_prompt else ''
@@ -215,11 +230,12 @@ class ElementExtractor:
             extra_prompt=extra_prompt_text
         )
         
-        logger.info(f'{task_no}：prompt长度={len(full_prompt)}, tokens≈{self._get_tokens_num(full_prompt)}')
+        prompt_tokens = self._get_tokens_num(full_prompt)
+        logger.info(f'{task_no}：prompt长度={len(full_prompt)}, tokens≈{prompt_tokens}')
         
         # 6. 调用大模型
         try:
-            if self._get_tokens_num(full_prompt) + 500 < self.ctx_limit:
+            if prompt_tokens + 500 < self.ctx_limit:
                 # 单次调用
                 result_dict = self._extract_single_pass(full_prompt, prefilled, money_schema, date_schema)
             else:
@@ -230,15 +246,29 @@ class ElementExtractor:
                 )
             
             # 7. 格式化结果
-            result_json = json.dumps(result_dict, ensure_ascii=False, indent=4)
+            result_json = json_dumps(result_dict, indent=4)
             logger.info(f'{task_no}：提取完成，结果: {result_json[:200]}...')
             
-            return result_json
+            return result_dict, result_json
             
         except Exception as e:
             logger.error(f'{task_no}：大模型提取失败: {e}')
             raise
     
+    def _parse_llm_json(self, text: str) -> Any:
+        """
+        解析大模型返回的 JSON：回答本身就是合法 JSON 对象时（json_mode 下总是如此）直接使用解析结果，
+        否则走 format_LLM_result 清洗后再解析，同一段文本不会被完整解析两次
+        """
+        try:
+            result = json_loads(text)
+        except (TypeError, ValueError):
+            pass
+        else:
+            if isinstance(result, dict) or getattr(self.llm_client, 'json_mode', False):
+                return result
+        return json_loads(OpenAICompatClient.format_LLM_result(text))
+    
     def _extract_single_pass(
         self,
         full_prompt: str,
@@ -250,11 +280,12 @@ class ElementExtractor:
         convert_status = False
         result_dict = {}
         
-        for _ in range(3):
+        for attempt in range(3):
             try:
-                result_text = self.llm_client.generate(prompt=full_prompt)
-                result = OpenAICompatClient.format_LLM_result(result_text)
-                result_dict = json.loads(result)
+                # 重试时跳过缓存，否则会拿到同一个无法解析的结果
+                result_text = self.llm_client.generate(prompt=full_prompt, use_cache=(attempt == 0))
+                result_dict = self._parse_llm_json(result_text)
+                self.llm_client.cache_response(full_prompt, result_text)  # 只缓存能解析的回答
                 
                 # 合并直填项
                 result_dict.update({k: v for k, v in prefilled.items() if v is not None})
@@ -277,6 +308,25 @@ class ElementExtractor:
         
         return result_dict
     
+    async def _agenerate_part(self, prompt: str, retry_count: int = 3) -> Optional[Dict[str, Any]]:
+        """单段调用大模型并解析为 dict；解析失败时跳过缓存重试，全部失败返回 None"""
+        for attempt in range(retry_count):
+            try:
+                # 重试时跳过缓存，否则会拿到同一个无法解析的结果
+                part_text = await self.llm_client.agenerate(prompt=prompt, use_cache=(attempt == 0))
+                d = self._parse_llm_json(part_text)
+            except Exception as e:
+                logger.error(f'分段 JSON 解析失败: {e}')
+                continue
+            if isinstance(d, dict):
+                self.llm_client.cache_response(prompt, part_text)  # 只缓存能解析的回答
+                return d
+        return None
+    
+    async def _agenerate_parts(self, prompts: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """并发调用大模型，返回各段解析结果，与 prompts 顺序一致"""
+        return await asyncio.gather(*[self._agenerate_part(p) for p in prompts])
+    
     def _extract_multi_pass(
         self,
         page_text_dict: Dict[int, str],
@@ -289,87 +339,80 @@ class ElementExtractor:
         date_schema: List[str]
     ) -> Dict[str, Any]:
         """分段调用大模型"""
-        part_json_dict = {}
-        part_index = 1
+        # 模板中只有 text 随分段变化，其余部分只格式化、只计算token一次
+        placeholder = '\x00TEXT\x00'
+        head, tail = contract_element_extract_prompt_pattern.format(
+            file_names=file_names_str,
+            text=placeholder,
+            schema_prompt=schema_prompt,
+            extra_prompt=extra_prompt_text
+        ).split(placeholder)
+        fixed_tokens = self._get_tokens_num(head) + self._get_tokens_num(tail)
+        
+        # 去掉内容完全相同的页（如多份扫描件中重复的封面、条款页），避免重复提交给大模型
+        seen_pages = set()
+        unique_pages: List[str] = []
+        for page_index in sorted(page_text_dict.keys()):
+            page_text = page_text_dict[page_index]
+            if page_text not in seen_pages:
+                seen_pages.add(page_text)
+                unique_pages.append(page_text)
+        page_text_dict = dict(enumerate(unique_pages, start=1))
+        
+        # 每页token数只计算一次，累计文本的token数增量维护，避免反复编码累计文本
+        page_tokens = {i: self._get_tokens_num(t) for i, t in page_text_dict.items()}
+        sep_tokens = self._get_tokens_num('\n\n')
+        
+        part_prompts: List[str] = []
         current_text = ""
         last_text = ""
+        acc_tokens = 0
         
         for page_index in sorted(page_text_dict.keys()):
             page_text = page_text_dict[page_index]
             if page_index == 1:
                 current_text = page_text
+                acc_tokens = page_tokens[page_index]
             else:
                 last_text = current_text
                 current_text += '\n\n' + page_text
+                acc_tokens += sep_tokens + page_tokens[page_index]
             
-            current_prompt = contract_element_extract_prompt_pattern.format(
-                file_names=file_names_str,
-                text=current_text,
-                schema_prompt=schema_prompt,
-                extra_prompt=extra_prompt_text
-            )
-            
-            if self._get_tokens_num(current_prompt) + 500 >= self.ctx_limit:
+            if fixed_tokens + acc_tokens + 500 >= self.ctx_limit:
                 if last_text.strip():
-                    input_text = contract_element_extract_prompt_pattern.format(
-                        file_names=file_names_str,
-                        text=last_text,
-                        schema_prompt=schema_prompt,
-                        extra_prompt=extra_prompt_text
-                    )
-                    part_text = self.llm_client.generate(prompt=input_text)
-                    part_text = OpenAICompatClient.format_LLM_result(part_text)
-                    part_json_dict[part_index] = part_text
-                    part_index += 1
+                    part_prompts.append(head + last_text + tail)
                 current_text = page_text  # 新段
+                acc_tokens = page_tokens[page_index]
         
         # 最后一段
-        input_text = contract_element_extract_prompt_pattern.format(
-            file_names=file_names_str,
-            text=current_text,
-            schema_prompt=schema_prompt,
-            extra_prompt=extra_prompt_text
-        )
-        part_text = self.llm_client.generate(prompt=input_text)
-        part_text = OpenAICompatClient.format_LLM_result(part_text)
-        part_json_dict[part_index] = part_text
+        part_prompts.append(head + current_text + tail)
+        
+        # 各段互不依赖，并发调用大模型；在进程共用的事件循环中执行，并发上限对所有任务线程合计生效
+        part_dicts = run_async(self._agenerate_parts(part_prompts))
         
         # 合并分段结果
-        result_dict_all = {}
-        for part_num, part_json in part_json_dict.items():
-            try:
-                d = json.loads(part_json)
-                result_dict_all[part_num] = d
-            except Exception:
-                pass
+        result_dict_all = {part_num: d for part_num, d in enumerate(part_dicts, start=1) if d is not None}
         
         if not result_dict_all:
             raise RuntimeError("分段提取结果为空")
         
-        df = pd.DataFrame(result_dict_all).T
-        
+        money_cols, date_cols = set(money_schema), set(date_schema)
         tmp_result = {}
         for col in money_schema + text_schema + date_schema:
-            if col not in df.columns:
-                tmp_result[col] = ''
-                continue
-            series = df[col].where(lambda x: x != '').dropna().map(str).str.strip('_ ')
-            if col in money_schema:
-                series = series.map(convert_to_number)
-            if col in date_schema:
-                series = series.map(convert_to_date)
-            if series.isnull().all():
-                tmp_result[col] = ''
-                continue
-            mode_series = series.mode(dropna=True)
-            if mode_series.shape[0] > 1:
-                value_list = list(series)
-                value = sorted(mode_series, key=value_list.index)[0]
-                tmp_result[col] = str(value)
-            elif mode_series.shape[0] == 1:
-                tmp_result[col] = str(mode_series.iloc[0])
-            else:
-                tmp_result[col] = ''
+            values = []
+            for d in result_dict_all.values():
+                v = d.get(col)
+                if v is None or v == '':
+                    continue
+                v = str(v).strip('_ ')
+                if col in money_cols:
+                    v = convert_to_number(v)
+                if col in date_cols:
+                    v = convert_to_date(v)
+                if v is not None:
+                    values.append(v)
+            # 取众数；出现次数相同时取最先出现的值（Counter 保留插入顺序）
+            tmp_result[col] = str(Counter(values).most_common(1)[0][0]) if values else ''
         
         tmp_result.update({k: v for k, v in prefilled.items() if v is not None})
         return tmp_result
@@ -1,31 +1,36 @@
+import os
 import requests
-import json
-import time
+import shutil
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from module.utils import to_list
-from loguru import logger
+from module.constants import SUPPORTED_EXTS
+from module.utils import to_list, get_module_logger, sleep_backoff, json_loads
 
-SUPPORTED_EXTS = {'pdf', 'jpg', 'jpeg', 'png', 'docx', 'txt','zip', 'rar'}
-COMPRESS_EXTS = {'zip', 'rar'}
-SUPPORTED_EXTS |= COMPRESS_EXTS
+try:
+    from requests_toolbelt.multipart.encoder import MultipartEncoder  # pip install requests-toolbelt
+except ImportError:
+    MultipartEncoder = None
+
+# 下载写文件时每次拷贝的字节数
+_WRITE_BUFFERING = 1024 * 1024
 
 class FileCenter():
-    def __init__(self, host, port, timeout=120):
+    def __init__(self, host, port, timeout=120, download_workers=8):
         self.host = host
         self.port = port
         self.getFilesByIdsUrl = f'http://{host}:{port}/files/ids'
         self.downloadUrl = f'http://{host}:{port}/files/' + '{id}'
         self.uploadUrl = f'http://{host}:{port}/files/upload'
         self.timeout = timeout
+        self.download_workers = download_workers  # 批量下载的并发线程数
+        # 复用连接池，避免每次请求重新建立 TCP 连接；重试由各方法自行处理
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-        log_name = 'file_center'
-        logger.add(f"logs/module_{log_name}_{{time:YYYY-MM-DD}}.log",
-               level="INFO",
-               rotation="00:00",
-               filter=lambda record: record["extra"].get("name") == log_name,
-               enqueue=False,
-               buffering=1)
-        self.logger = logger.bind(name=log_name)
+        self.logger = get_module_logger('file_center')
 
     def get_files_info(self, fileIds, retry_count=3, retry_delay=3):
         """
@@ -33,7 +38,7 @@ class FileCenter():
 
         :param fileIds: 文件 ID 列表或单个 ID
         :param retry_count: 最大重试次数
-        :param retry_delay: 失败后等待的秒数
+        :param retry_delay: 首次重试前的基础等待秒数，之后指数退避
         :return: 成功返回 JSON 数据，失败抛出异常
         """
         fileIds = to_list(fileIds)
@@ -43,10 +48,10 @@ class FileCenter():
 
         for attempt in range(1, retry_count + 1):
             try:
-                response = requests.post(self.getFilesByIdsUrl, json=data, timeout=self.timeout)
+                response = self.session.post(self.getFilesByIdsUrl, json=data, timeout=self.timeout)
                 response.raise_for_status()  # 确保响应状态码为 2xx
                 self.logger.info(f'获取文件信息成功：{fileIds}')
-                return response.json()['datas']  # 请求成功，返回结果
+                return json_loads(response.content)['datas']  # 请求成功，返回结果
                 # {'datas': [{'id': 'ca806ed797ad429b86bf811b9b67560f',
                 #    'name': '前端开发规范集成指南-新版.pdf',
                 #    'isImg': False,
@@ -64,12 +69,12 @@ class FileCenter():
                 last_exception = requests.Timeout("请求超时")
                 self.logger.warning(f"请求文件超时，正在进行第 {attempt}/{retry_count} 次重试...")
 
-            except requests.RequestException as e:
+            except (requests.RequestException, ValueError) as e:
                 last_exception = e
                 self.logger.warning(f"请求文件失败: {e}，正在进行第 {attempt}/{retry_count} 次重试...")
 
             if attempt < retry_count:
-                time.sleep(retry_delay)  # 等待后重试
+                sleep_backoff(attempt - 1, retry_delay)  # 指数退避后再重试
 
         self.logger.error(f'请求失败，已重试 {retry_count} 次但未成功：{fileIds}')
         # 若所有尝试都失败，抛出最后一次异常
@@ -83,21 +88,23 @@ class FileCenter():
         :param file_id: 文件ID
         :param file_path: 保存的本地路径
         :param retry_count: 最大重试次数
-        :param retry_delay: 失败后等待的秒数
+        :param retry_delay: 首次重试前的基础等待秒数，之后指数退避
         """
         url = self.downloadUrl.format(id=file_id)
 
         for attempt in range(1, retry_count + 1):
             try:
-                response = requests.get(url, stream=True, timeout=self.timeout)  # 添加超时
-                if response.status_code == 200:
-                    with open(file_path, "wb") as file:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            file.write(chunk)
-                    self.logger.info(f"下载完成: {file_id} {file_path}")
-                    return True  # 下载成功
-                else:
-                    self.logger.error(f"下载失败，状态码: {response.status_code}")
+                # 用 with 确保连接在任何情况下都归还连接池
+                with self.session.get(url, stream=True, timeout=self.timeout) as response:  # 添加超时
+                    if response.status_code == 200:
+                        # 按 1MB 大块拷贝，减少循环次数和写系统调用；decode_content 保证 gzip 等编码被解压
+                        response.raw.decode_content = True
+                        with open(file_path, "wb") as file:
+                            shutil.copyfileobj(response.raw, file, length=_WRITE_BUFFERING)
+                        self.logger.info(f"下载完成: {file_id} {file_path}")
+                        return True  # 下载成功
+                    else:
+                        self.logger.error(f"下载失败，状态码: {response.status_code}")
 
             except requests.Timeout:
                 self.logger.warning(f"请求超时，正在进行第 {attempt}/{retry_count} 次重试...")
@@ -105,7 +112,7 @@ class FileCenter():
                 self.logger.warning(f"下载失败: {e}，正在进行第 {attempt}/{retry_count} 次重试...")
 
             if attempt < retry_count:
-                time.sleep(retry_delay)  # 等待后重试
+                sleep_backoff(attempt - 1, retry_delay)  # 指数退避后再重试
 
         self.logger.error(f"下载失败，已重试{retry_count}次仍未成功：{file_id} {file_path}")
         return False  # 下载失败
@@ -119,16 +126,25 @@ class FileCenter():
         for attempt in range(1, retry_count + 1):
             try:
                 with open(file_path, 'rb') as f:
-                    files_report = {'file': (file_path.name, f, suffix)}
-                    response = requests.post(self.uploadUrl, files=files_report, data=datas, timeout=self.timeout)
+                    if MultipartEncoder is not None:
+                        # 流式编码 multipart，文件边读边发，不在内存中拼接完整请求体；
+                        # MultipartEncoder 只接受 str/bytes，按 requests 的 data= 规则转换（None 丢弃、其余转 str）
+                        fields = {k: str(v) for k, v in datas.items() if v is not None}
+                        encoder = MultipartEncoder(fields={**fields, 'file': (file_path.name, f, suffix)})
+                        response = self.session.post(self.uploadUrl, data=encoder,
+                                                     headers={'Content-Type': encoder.content_type},
+                                                     timeout=self.timeout)
+                    else:
+                        files_report = {'file': (file_path.name, f, suffix)}
+                        response = self.session.post(self.uploadUrl, files=files_report, data=datas, timeout=self.timeout)
                     response.raise_for_status()  # 确保响应状态码为 2xx
                     self.logger.info(f'上传文件成功：{file_path}')
-                    return response.json().get('id')  # 请求成功，返回文件id
+                    return json_loads(response.content).get('id')  # 请求成功，返回文件id
             except requests.Timeout:
                 self.logger.warning(f"请求超时，正在进行第 {attempt}/{retry_count} 次重试...")
                 if attempt < retry_count:
-                    time.sleep(retry_delay)  # 增加延迟再重试
-            except requests.RequestException as e:
+                    sleep_backoff(attempt - 1, retry_delay)  # 指数退避后再重试
+            except (requests.RequestException, ValueError) as e:
                 self.logger.warning(f"请求失败: {e}")
                 break  # 遇到非超时的错误，直接终止
         self.logger.error(f'上传文件失败，已重试{retry_count}次仍未成功：{file_path}')
@@ -154,20 +170,21 @@ class FileCenter():
         提取文件id和名称映射关系
         """
         result_Dict = {}
+        used_names = set()
+        name_counter = {}  # 重名文件下一个待尝试的序号
         for data in datas:
-            if Path(data['name']).suffix.lstrip('.').lower() not in SUPPORTED_EXTS:
+            name = data['name']
+            stem, ext = os.path.splitext(name)
+            if ext[1:].lower() not in SUPPORTED_EXTS:
                 continue
-            if data['name'] in result_Dict.values():
-                path = Path(data['name'])
-                number_suffix = 1
-                while True:
-                    if f'{path.stem}_{number_suffix:03d}{path.suffix}' in result_Dict.values():
-                        number_suffix += 1
-                    else:
-                        break
-                result_Dict[data['id']] = f'{path.stem}_{number_suffix:03d}{path.suffix}'
-            else:
-                result_Dict[data['id']] = data['name']
+            if name in used_names:
+                number_suffix = name_counter.get(name, 1)
+                while f'{stem}_{number_suffix:03d}{ext}' in used_names:
+                    number_suffix += 1
+                name_counter[name] = number_suffix + 1
+                name = f'{stem}_{number_suffix:03d}{ext}'
+            used_names.add(name)
+            result_Dict[data['id']] = name
         return result_Dict
 
     def download_files(self, id_name_mapping, save_dir, retry_count=3, retry_delay=3):
@@ -177,7 +194,7 @@ class FileCenter():
         :param id_name_mapping: {file_id: file_name} 映射
         :param save_dir: 本地保存目录
         :param retry_count: 最大重试次数
-        :param retry_delay: 失败后等待时间
+        :param retry_delay: 首次重试前的基础等待秒数，之后指数退避
         :return: 成功和失败的文件列表
         """
         save_dir = Path(save_dir)
@@ -185,11 +202,30 @@ class FileCenter():
 
         success_list, failure_list = [], []
 
+        file_path_mapping = {}
         for file_id, file_name in id_name_mapping.items():
             file_path = save_dir / file_name  # 生成完整的本地文件路径
             self.logger.info(f"开始下载文件: {file_name} (ID: {file_id}) 到 {file_path}")
+            file_path_mapping[file_id] = file_path
+
+        # 各文件在线程池中并发下载（requests 在等待网络时释放 GIL），共用 session 的连接池
+        results = {}
+        if file_path_mapping:
+            max_workers = min(self.download_workers, len(file_path_mapping))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    file_id: executor.submit(self.download_file, file_id, file_path, retry_count, retry_delay)
+                    for file_id, file_path in file_path_mapping.items()
+                }
+                for file_id, future in futures.items():
+                    try:
+                        results[file_id] = future.result()
+                    except Exception as e:
+                        self.logger.error(f"下载异常: {id_name_mapping[file_id]} {e}")
+                        results[file_id] = False
 
-            if self.download_file(file_id, file_path, retry_count, retry_delay):
+        for file_id, file_name in id_name_mapping.items():
+            if results.get(file_id):
                 success_list.append(file_id)
                 self.logger.info(f"文件下载成功: {file_name}")
             else:
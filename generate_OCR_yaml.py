@@ -59,5 +59,16 @@ SubModules:
 """.strip()
 
 
-with open(f'{abspath}OCR.yaml','w',encoding='utf-8') as f:
-    f.write(yaml_content)
+# 内容未变化时不重写文件（路径、GPU 配置不变的重复执行无需写盘）
+yaml_path = f'{abspath}OCR.yaml'
+if os.path.exists(yaml_path):
+    with open(yaml_path, 'r', encoding='utf-8') as f:
+        unchanged = f.read() == yaml_content
+else:
+    unchanged = False
+
+if unchanged:
+    print(f"{yaml_path} 未变化，跳过写入")
+else:
+    with open(yaml_path, 'w', encoding='utf-8') as f:
+        f.write(yaml_content)
@@ -1,7 +1,29 @@
 # module/llm_openai.py
-import json
 import re
-import requests
+import asyncio
+import httpx
+
+from module.utils import LRUCache, sleep_backoff, backoff_delay, is_retryable_status, json_loads, run_async
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.+?)\s*```", re.S)
+_TRAIL_COMMA_OBJ = re.compile(r",\s*}")
+_TRAIL_COMMA_ARR = re.compile(r",\s*]")
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2（pip install httpx[http2]）
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+def _sse_delta(line: str):
+    """解析流式响应的一行：返回增量文本，非 data 行返回空串，流结束（[DONE]）返回 None"""
+    if not line.startswith("data:"):
+        return ""
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return None
+    choices = json_loads(data).get("choices")
+    return (choices[0].get("delta", {}).get("content") or "") if choices else ""
 
 class OpenAICompatClient:
     """
@@ -17,6 +39,11 @@ class OpenAICompatClient:
         top_p: float = 0.95,
         max_tokens: int = 1024,
         api_key: str | None = None,
+        cache_enabled: bool = True,
+        cache_maxsize: int = 1024,
+        max_concurrent: int = 4,
+        json_mode: bool = False,
+        stream: bool = False,
     ):
         self.base_url = base_url.rstrip("/")
         self.model = model
@@ -26,6 +53,33 @@ class OpenAICompatClient:
         self.top_p = top_p
         self.max_tokens = max_tokens
         self.api_key = api_key
+        # 相同 payload 的请求直接返回缓存结果，避免重复调用大模型；只缓存 temperature=0 的确定性回答，
+        # 且 generate/agenerate 只读缓存，回答由调用方解析成功后通过 cache_response 写入，不可用的回答不会被反复重放
+        self._cache = LRUCache(maxsize=cache_maxsize) if cache_enabled else None
+        # agenerate 的并发上限，与服务端可同时解码的请求数匹配，超出部分在本地排队；
+        # agenerate 统一经 utils.run_async 在进程共用的事件循环中执行，因此是进程级上限
+        self._sem = asyncio.Semaphore(max_concurrent)
+        # 开启后请求带 response_format=json_object，服务端保证返回严格 JSON，调用方可直接解析
+        self.json_mode = json_mode
+        # 流式接收回答：超时按相邻两次数据的间隔计算，长回答不会因总耗时过长而读超时
+        self.stream = stream
+        # 复用连接，多次调用之间不必重新建立 TCP 连接；安装了 h2 且服务端支持时使用 HTTP/2
+        self._client = httpx.Client(
+            http2=_HTTP2,
+            timeout=timeout,
+            limits=httpx.Limits(max_keepalive_connections=16),
+        )
+        # agenerate 用的异步连接池，只在 utils.run_async 的共用事件循环中使用，多段调用之间保持长连接
+        self._aclient = httpx.AsyncClient(
+            http2=_HTTP2,
+            timeout=timeout,
+            limits=httpx.Limits(max_keepalive_connections=16),
+        )
+
+    def close(self):
+        """关闭连接池"""
+        self._client.close()
+        run_async(self._aclient.aclose())
 
     def _headers(self):
         h = {"Content-Type": "application/json"}
@@ -33,10 +87,19 @@ class OpenAICompatClient:
             h["Authorization"] = f"Bearer {self.api_key}"
         return h
 
-    def generate(self, prompt: str) -> str:
-        """
-        返回大模型的纯文本回答（chat.completions）
-        """
+    def _cache_key(self, payload: dict):
+        """可缓存时返回缓存键；未开启缓存或 temperature > 0（采样结果不确定）时返回 None"""
+        if self._cache is None or payload["temperature"] != 0:
+            return None
+        return LRUCache.make_key(payload)
+
+    def cache_response(self, prompt: str, content: str) -> None:
+        """调用方确认回答可用（如 JSON 解析成功）后写入缓存"""
+        cache_key = self._cache_key(self._payload(prompt))
+        if cache_key is not None and content is not None:
+            self._cache.set(cache_key, content)
+
+    def _payload(self, prompt: str) -> dict:
         payload = {
             "model": self.model,
             "messages": (
@@ -46,11 +109,118 @@ class OpenAICompatClient:
             "top_p": self.top_p,
             "max_tokens": self.max_tokens,
         }
+        if self.json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        return payload
+
+    def _post_once(self, url: str, payload: dict):
+        """
+        发送一次请求，返回 (响应, 回答文本)；状态码非 2xx 时回答文本为 None
+        """
+        if not self.stream:
+            resp = self._client.post(url, headers=self._headers(), json=payload)
+            if not resp.is_success:
+                return resp, None
+            return resp, json_loads(resp.content)["choices"][0]["message"]["content"]
+
+        with self._client.stream("POST", url, headers=self._headers(), json={**payload, "stream": True}) as resp:
+            if not resp.is_success:
+                resp.read()
+                return resp, None
+            if not resp.headers.get("content-type", "").startswith("text/event-stream"):
+                # 服务端不支持流式时按普通响应解析
+                resp.read()
+                return resp, json_loads(resp.content)["choices"][0]["message"]["content"]
+            parts = []
+            for line in resp.iter_lines():
+                delta = _sse_delta(line)
+                if delta is None:
+                    break
+                parts.append(delta)
+            return resp, "".join(parts)
+
+    async def _apost_once(self, url: str, payload: dict):
+        """_post_once 的协程版本"""
+        if not self.stream:
+            resp = await self._aclient.post(url, headers=self._headers(), json=payload)
+            if not resp.is_success:
+                return resp, None
+            return resp, json_loads(resp.content)["choices"][0]["message"]["content"]
+
+        async with self._aclient.stream("POST", url, headers=self._headers(), json={**payload, "stream": True}) as resp:
+            if not resp.is_success:
+                await resp.aread()
+                return resp, None
+            if not resp.headers.get("content-type", "").startswith("text/event-stream"):
+                # 服务端不支持流式时按普通响应解析
+                await resp.aread()
+                return resp, json_loads(resp.content)["choices"][0]["message"]["content"]
+            parts = []
+            async for line in resp.aiter_lines():
+                delta = _sse_delta(line)
+                if delta is None:
+                    break
+                parts.append(delta)
+            return resp, "".join(parts)
+
+    def generate(self, prompt: str, use_cache: bool = True, retry_count: int = 3, retry_delay: float = 3) -> str:
+        """
+        返回大模型的纯文本回答（chat.completions）
+        :param use_cache: 为 False 时跳过缓存读取，用于结果不可用时的重试；本方法不写缓存，见 cache_response
+        :param retry_count: 连接失败、超时或 5xx/429 时的最大尝试次数
+        :param retry_delay: 首次重试前的基础等待秒数，之后指数退避
+        """
+        payload = self._payload(prompt)
+        cache_key = self._cache_key(payload) if use_cache else None
+        if cache_key is not None:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        url = f"{self.base_url}/v1/chat/completions"
+        retry_count = max(1, retry_count)  # 至少请求一次，否则 resp 未赋值
+        for attempt in range(retry_count):
+            last_attempt = attempt == retry_count - 1
+            try:
+                resp, content = self._post_once(url, payload)
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            else:
+                if content is not None or last_attempt or not is_retryable_status(resp.status_code):
+                    break
+            sleep_backoff(attempt, retry_delay)  # 指数退避后再重试
+        resp.raise_for_status()
+        return content
+
+    async def agenerate(self, prompt: str, use_cache: bool = True, retry_count: int = 3, retry_delay: float = 3) -> str:
+        """
+        generate 的协程版本（缓存、重试、流式处理相同），多段 prompt 可通过 asyncio.gather 并发调用；
+        需通过 utils.run_async 在共用事件循环中执行，并发上限才对整个进程生效
+        """
+        payload = self._payload(prompt)
+        cache_key = self._cache_key(payload) if use_cache else None
+        if cache_key is not None:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                return cached
+
         url = f"{self.base_url}/v1/chat/completions"
-        resp = requests.post(url, headers=self._headers(), json=payload, timeout=self.timeout)
+        retry_count = max(1, retry_count)  # 至少请求一次，否则 resp 未赋值
+        for attempt in range(retry_count):
+            last_attempt = attempt == retry_count - 1
+            try:
+                async with self._sem:
+                    resp, content = await self._apost_once(url, payload)
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            else:
+                if content is not None or last_attempt or not is_retryable_status(resp.status_code):
+                    break
+            await asyncio.sleep(backoff_delay(attempt, retry_delay))  # 退避期间不占用并发名额
         resp.raise_for_status()
-        data = resp.json()
-        return data["choices"][0]["message"]["content"]
+        return content
 
     @staticmethod
     def format_LLM_result(text: str) -> str:
@@ -60,9 +230,9 @@ class OpenAICompatClient:
         if not isinstance(text, str):
             raise ValueError("LLM 返回内容不是字符串")
 
-        # 去除 Markdown 代码块
         text = text.strip()
-        code_fence = re.search(r"```(?:json)?\s*(.+?)\s*```", text, flags=re.S)
+        # 去除 Markdown 代码块
+        code_fence = _FENCE_RE.search(text)
         if code_fence:
             text = code_fence.group(1).strip()
 
@@ -73,10 +243,10 @@ class OpenAICompatClient:
 
         # 校验是否为 JSON
         try:
-            _ = json.loads(text)
+            _ = json_loads(text)
         except Exception:
             # 尝试常见错误修复：去掉末尾逗号
-            text = re.sub(r",\s*}", "}", text)
-            text = re.sub(r",\s*]", "]", text)
-            _ = json.loads(text)  # 再试一次，失败就抛
+            text = _TRAIL_COMMA_OBJ.sub("}", text)
+            text = _TRAIL_COMMA_ARR.sub("]", text)
+            _ = json_loads(text)  # 再试一次，失败就抛
         return text
@@ -4,10 +4,11 @@
 业务逻辑：PDF OCR -> Prompt拼接 -> LLM调用 -> 结果返回
 """
 from pathlib import Path
-import json
 import os
 import time
-from fastapi import FastAPI, BackgroundTasks
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 import uvicorn
@@ -18,11 +19,12 @@ from typing import List
 from module.config_loader import ConfigLoader
 from module.callback import CallbackClient
 from module.file_center import FileCenter
+from module.constants import SUPPORTED_EXTS
 from module.ocr import OcrTool, OcrError
 from module.ocrvl import OcrVL as OcrVLClient
 from module.llm_openai import OpenAICompatClient
 from module.extractor import ElementExtractor
-from module.utils import delete_path
+from module.utils import clear_dir, DailySizeRotation, LOG_RETENTION, LOG_COMPRESSION
 from module.seal import SealTool
 
 ####################################
@@ -34,17 +36,16 @@ app = FastAPI(
     redoc_url='/redocs',
 )
 
-# 文件白名单
-SUPPORTED_EXTS = {'pdf', 'jpg', 'jpeg', 'png', 'docx', 'txt'}
-COMPRESS_EXTS = {'zip', 'rar'}
-SUPPORTED_EXTS |= COMPRESS_EXTS
-
 # 日志
 logger.remove()
 logger.add(
     'logs/log_{time:YYYY-MM-DD}.log',
-    rotation="00:00",
+    rotation=DailySizeRotation(),
+    retention=LOG_RETENTION,
+    compression=LOG_COMPRESSION,
     level="INFO",
+    enqueue=True,
+    buffering=65536,
 )
 logger.info("Application startup initiated.")
 
@@ -85,12 +86,16 @@ tokenizer = None
 extractor: ElementExtractor = None
 callback_client: CallbackClient = None
 file_center: FileCenter = None
+# 提取任务专用线程池，与 FastAPI 同步接口共用的默认线程池隔离
+task_executor: ThreadPoolExecutor = None
+# 预建的任务工作目录编号，每个任务借用一个，结束后清空归还
+task_slot_pool: queue.Queue = None
 
 ####################################
 @app.on_event("startup")
 def startup_event():
     """应用启动时初始化各组件"""
-    global config_loader, ocr_tool, llm_client, tokenizer, extractor, callback_client, file_center, seal_tool
+    global config_loader, ocr_tool, llm_client, tokenizer, extractor, callback_client, file_center, seal_tool, task_executor, task_slot_pool
     
     # 1. 加载配置
     env = os.environ.get('APP_ENV', 'local')
@@ -152,6 +157,9 @@ def startup_event():
         top_p=openai_cfg.get("top_p", 0.9),
         max_tokens=openai_cfg.get("max_tokens", 2048),
         api_key=openai_cfg.get("api_key"),
+        max_concurrent=openai_cfg.get("max_concurrent", 4),
+        json_mode=openai_cfg.get("json_mode", False),
+        stream=openai_cfg.get("stream", False),
     )
     ctx_limit = int(openai_cfg.get("ctx_limit", 16000))
     logger.info(f"LLM客户端初始化完成: {openai_cfg['base_url']}, model={openai_cfg['model']}")
@@ -203,9 +211,48 @@ def startup_event():
         seal_tool=seal_tool
     )
     logger.info("要素提取器初始化完成")
+    
+    # 9. 初始化任务线程池
+    task_workers = int(config_loader.get_app_config().get('task_workers', 8))
+    task_executor = ThreadPoolExecutor(max_workers=task_workers, thread_name_prefix='extract')
+    logger.info(f"任务线程池初始化完成: max_workers={task_workers}")
+    
+    # 10. 预建任务工作目录，数量与线程池并发数一致，任务间复用
+    task_slot_pool = queue.Queue()
+    for slot in range(task_workers):
+        for folder in (tmp_file_folder, ocr_txt_folder):
+            slot_folder = folder / f'slot_{slot}'
+            slot_folder.mkdir(exist_ok=True, parents=True)
+            clear_dir(slot_folder)  # 清掉上次异常退出残留的文件
+        task_slot_pool.put(slot)
     logger.info("应用启动完成")
 
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """应用关闭时释放连接资源"""
+    if task_executor is not None:
+        task_executor.shutdown(wait=False)
+    if callback_client is not None:
+        callback_client.close()
+    if llm_client is not None:
+        llm_client.close()
+
 ####################################
+def log_task_exception(future):
+    """线程池任务的完成回调：记录未被任务内部捕获的异常"""
+    exc = future.exception()
+    if exc is not None:
+        logger.opt(exception=exc).error('提取任务异常退出')
+
+def find_unsupported_suffix(file_info_list):
+    """返回第一个不支持的文件后缀，全部支持时返回 None"""
+    for item in file_info_list:
+        suffix = os.path.splitext(item['name'])[1][1:].lower()
+        if suffix not in SUPPORTED_EXTS:
+            return suffix
+    return None
+
 def async_contract_element_extract(input_request: InputRequest):
     """
     异步处理合同要素提取任务
@@ -221,11 +268,11 @@ def async_contract_element_extract(input_request: InputRequest):
     extra_prompt = input_request.prompt
     config = input_request.config
     
-    # 任务目录
-    task_file_folder = tmp_file_folder / task_no
-    task_file_folder.mkdir(exist_ok=True, parents=True)
-    task_ocr_txt_folder = ocr_txt_folder / task_no
-    task_ocr_txt_folder.mkdir(exist_ok=True, parents=True)
+    # 任务目录：借用预建的工作目录，避免每个任务新建、删除目录
+    slot = task_slot_pool.get()
+    task_file_folder = tmp_file_folder / f'slot_{slot}'
+    task_ocr_txt_folder = ocr_txt_folder / f'slot_{slot}'
+    logger.info(f'{task_no}：使用工作目录 slot_{slot}')
     
     try:
         total_start_time = time.time()
@@ -245,52 +292,64 @@ def async_contract_element_extract(input_request: InputRequest):
         logger.info(f'{task_no}：待OCR文件={to_ocr_file_id_list}')
         logger.info(f'{task_no}：已有OCR文件={ocr_txt_file_id_list}')
         
-        # 下载已有OCR的txt文件
+        # 下载文件：已有OCR的txt文件与待OCR的原始文件一次查询信息、并发下载
         get_files_start_time = time.time()
-        ocr_txt_file_mapping_dict = {}
-        if ocr_txt_file_id_list:
-            try:
-                ocr_txt_file_info_list = file_center.get_files_info(fileIds=ocr_txt_file_id_list)
-                ocr_txt_file_mapping_dict = file_center.extract_id_name_mapping(ocr_txt_file_info_list)
-                ocr_ok, ocr_fail = file_center.download_files(
-                    id_name_mapping=ocr_txt_file_mapping_dict,
-                    save_dir=task_file_folder
-                )
-                logger.info(f'{task_no}：OCR文件下载结果：成功={ocr_ok}, 失败={ocr_fail}')
-                new_to_ocr = [fid for fid, ofid in input_ocr_result_mapping_dict.items() if ofid in ocr_fail]
-            except Exception as e:
-                logger.error(f'{task_no}：获取已OCR文件失败: {e}')
+        ocr_txt_file_mapping_dict, to_ocr_file_mapping_dict = {}, {}
+        ocr_txt_id_set = set(ocr_txt_file_id_list)
+        try:
+            all_file_id_list = list(dict.fromkeys(ocr_txt_file_id_list + to_ocr_file_id_list))
+            file_info_list = file_center.get_files_info(fileIds=all_file_id_list) if all_file_id_list else []
+            
+            # 检查文件类型
+            suffix = find_unsupported_suffix(item for item in file_info_list if item['id'] not in ocr_txt_id_set)
+            if suffix is not None:
+                callback_client.send_error_result(task_no, f'文件类型不支持: {suffix}')
+                return
+            
+            file_mapping_dict = file_center.extract_id_name_mapping(file_info_list)
+            ok, fail = file_center.download_files(
+                id_name_mapping=file_mapping_dict,
+                save_dir=task_file_folder
+            )
+            fail_set = set(fail)
+            for fid, name in file_mapping_dict.items():
+                if fid not in fail_set:
+                    if fid in ocr_txt_id_set:
+                        ocr_txt_file_mapping_dict[fid] = name
+                    else:
+                        to_ocr_file_mapping_dict[fid] = name
+            
+            raw_fail = [fid for fid in fail if fid not in ocr_txt_id_set]
+            if raw_fail or (to_ocr_file_id_list and not to_ocr_file_mapping_dict):
+                logger.error(f'{task_no}：原文件下载失败：{raw_fail}')
                 callback_client.send_error_result(task_no, '获取文件失败')
                 return
-        else:
-            new_to_ocr = []
-        
-        # 下载待OCR的原始文件
-        to_ocr_file_mapping_dict = {}
-        if to_ocr_file_id_list + new_to_ocr:
-            try:
-                to_ocr_file_info_list = file_center.get_files_info(fileIds=to_ocr_file_id_list + new_to_ocr)
-                to_ocr_file_mapping_dict = file_center.extract_id_name_mapping(to_ocr_file_info_list)
-                
-                # 检查文件类型
-                for item in to_ocr_file_info_list:
-                    suffix = Path(item['name']).suffix.lstrip('.').lower()
-                    if suffix not in SUPPORTED_EXTS:
-                        callback_client.send_error_result(task_no, f'文件类型不支持: {suffix}')
-                        return
-                
+            ocr_fail = [fid for fid in fail if fid in ocr_txt_id_set]
+            if ocr_txt_file_id_list:
+                logger.info(f'{task_no}：OCR文件下载结果：成功={list(ocr_txt_file_mapping_dict)}, 失败={ocr_fail}')
+            
+            # 已有OCR的txt文件下载失败时，改为下载原始文件重新OCR
+            new_to_ocr = [fid for fid, ofid in input_ocr_result_mapping_dict.items() if ofid and ofid in ocr_fail]
+            if new_to_ocr:
+                new_file_info_list = file_center.get_files_info(fileIds=new_to_ocr)
+                suffix = find_unsupported_suffix(new_file_info_list)
+                if suffix is not None:
+                    callback_client.send_error_result(task_no, f'文件类型不支持: {suffix}')
+                    return
+                new_file_mapping_dict = file_center.extract_id_name_mapping(new_file_info_list)
                 ok, fail = file_center.download_files(
-                    id_name_mapping=to_ocr_file_mapping_dict,
+                    id_name_mapping=new_file_mapping_dict,
                     save_dir=task_file_folder
                 )
                 if fail or not ok:
                     logger.error(f'{task_no}：原文件下载失败：{fail}')
                     callback_client.send_error_result(task_no, '获取文件失败')
                     return
-            except Exception as e:
-                logger.error(f'{task_no}：下载文件失败: {e}')
-                callback_client.send_error_result(task_no, '获取文件失败')
-                return
+                to_ocr_file_mapping_dict.update(new_file_mapping_dict)
+        except Exception as e:
+            logger.error(f'{task_no}：下载文件失败: {e}')
+            callback_client.send_error_result(task_no, '获取文件失败')
+            return
         
         get_files_end_time = time.time()
         logger.info(f'{task_no}：获取文件耗时：{get_files_end_time - get_files_start_time:.2f}s')
@@ -309,7 +368,7 @@ def async_contract_element_extract(input_request: InputRequest):
         
         # 2. 执行要素提取（OCR -> Prompt -> LLM -> 返回）
         try:
-            result_json = extractor.extract(
+            result_dict, result_json = extractor.extract(
                 files=files,
                 config=config,
                 extra_prompt=extra_prompt,
@@ -320,8 +379,7 @@ def async_contract_element_extract(input_request: InputRequest):
             )
             
             # 检查结果是否全为空
-            result_dict = json.loads(result_json)
-            if all(map(lambda x: x == '', result_dict.values())):
+            if all(v == '' for v in result_dict.values()):
                 logger.warning(f'{task_no}：大模型提取要素结果全为空')
                 callback_client.send_error_result(task_no, '大模型提取要素结果全为空')
                 return
@@ -343,22 +401,24 @@ def async_contract_element_extract(input_request: InputRequest):
             callback_client.send_error_result(task_no, '大模型提取要素失败')
     
     finally:
-        # 清理临时文件
+        # 清理临时文件并归还工作目录
         try:
-            delete_path(task_file_folder)
-            delete_path(task_ocr_txt_folder)
+            clear_dir(task_file_folder)
+            clear_dir(task_ocr_txt_folder)
         except Exception:
             pass
+        task_slot_pool.put(slot)
 
 ####################################
 @app.post('/v1/contract_element_extract')
-def contract_element_extract(input_request: InputRequest, background_tasks: BackgroundTasks):
+def contract_element_extract(input_request: InputRequest):
     """合同要素提取接口"""
     try:
         task_no = input_request.taskNo
         logger.info(f'{task_no}：请求已接收')
         data = {'message': f'任务{task_no}已接受', 'code': 0}
-        background_tasks.add_task(async_contract_element_extract, input_request)
+        future = task_executor.submit(async_contract_element_extract, input_request)
+        future.add_done_callback(log_task_exception)
         return JSONResponse(content=data, status_code=200)
     except Exception as e:
         logger.exception(e)
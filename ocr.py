@@ -1,20 +1,40 @@
 import fitz
 import paddle
 import docx
-from module.utils import to_list
+from module.utils import to_list, get_module_logger, LRUCache
+from module.pdf_text import read_pdf_pages, normalize_ws, FITZ_LOCK, fitz_locked
 import numpy as np
 from PIL import Image
-from loguru import logger
 from pathlib import Path
 from docx.opc.constants import RELATIONSHIP_TYPE as RT
-import tempfile, shutil, re
-import tempfile, io
+import shutil, re
+import io
 from collections import Counter
-import subprocess, shlex, sys, os
+from concurrent.futures import ThreadPoolExecutor
+import subprocess, sys, os
+import hashlib
+import functools
+import threading
+try:
+    import xxhash            # 可选依赖：pip install xxhash，缺失时回退到 hashlib.blake2b
+except ImportError:
+    xxhash = None
+try:
+    import cv2               # paddlex 依赖 opencv，通常已安装；缺失时回退到 PIL 解码
+except ImportError:
+    cv2 = None
+
+# 文本清洗用到的正则，模块加载时编译一次，逐页循环中直接复用
+_RE_PARAGRAPH = re.compile(r'(\n\s*)+')               # 连续换行/空行
+_RE_EFF_WS = re.compile(r'[\s\r\n\t\xa0]+')           # 有效字符统计：空白
+_RE_EFF_SYM = re.compile(r'[^\w\u4e00-\u9fa5]')       # 有效字符统计：符号
+
 ### PATCH‑A：文件后缀白名单
 SUPPORTED_EXTS = {'pdf', 'jpg', 'jpeg', 'png', 'docx', 'doc', 'txt'}
 COMPRESS_EXTS = {'zip', 'rar'}
 SUPPORTED_EXTS |= COMPRESS_EXTS
+# 解压后需要保留的文件后缀
+EXTRACTABLE_EXTS = frozenset(SUPPORTED_EXTS - COMPRESS_EXTS)
 
 ### PATCH‑B：安全解压函数（放在 ocr.py 里即可）
 import zipfile
@@ -25,15 +45,34 @@ except ImportError:
 from collections import Counter
 
 def is_watermark_dominated(text: str, top_rate: float = 0.5) -> bool:
-    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    """
+    出现次数最多的非空行占比 >= top_rate 时视为水印主导。
+    边计数边判断：某行次数已达阈值即返回 True，剩余行数不足以让任何行达到阈值即返回 False。
+    """
+    lines = [ln for ln in map(str.strip, text.splitlines()) if ln]
     if not lines:
         return True
-    top_cnt = Counter(lines).most_common(1)[0][1]
-    return top_cnt / len(lines) >= top_rate
+    total = len(lines)
+    threshold = top_rate * total
+    counts = {}
+    max_cnt = 0
+    for i, ln in enumerate(lines):
+        cnt = counts.get(ln, 0) + 1
+        counts[ln] = cnt
+        if cnt > max_cnt:
+            max_cnt = cnt
+            if max_cnt >= threshold:
+                return True
+        if max_cnt + (total - i - 1) < threshold:
+            return False
+    return False
+
+
+@functools.lru_cache(maxsize=1)
 def get_sevenz_path() -> Path:
     """
     返回项目内 7‑Zip 可执行文件的 Path。
-    每次调用都会重新计算和 exists() 校验。
+    校验（exists、执行权限）成功后结果缓存至进程结束；校验失败抛出的异常不会被缓存，下次调用会重新检查。
     """
     base_dir = Path(__file__).resolve().parent          # ocr.py 所在目录
     seven = base_dir / "tools" / ("7z.exe" if sys.platform.startswith("win") else "7zz")
@@ -50,6 +89,28 @@ def get_sevenz_path() -> Path:
     return seven
 
 
+def _extract_zip_members(zf: zipfile.ZipFile, dst_dir: Path) -> None:
+    """
+    逐个条目流式解压，只写出后缀在 EXTRACTABLE_EXTS 内的文件，其余条目不落盘。
+    与 extractall 一样去掉盘符、绝对路径前缀与 '..'，防止写出 dst_dir 之外。
+    """
+    members = []
+    for zi in zf.infolist():
+        if zi.is_dir():
+            continue
+        name = os.path.splitdrive(zi.filename)[1].replace('\\', '/')
+        parts = [p for p in name.split('/') if p not in ('', '.', '..')]
+        if not parts or Path(parts[-1]).suffix.lstrip('.').lower() not in EXTRACTABLE_EXTS:
+            continue
+        members.append((zi, dst_dir.joinpath(*parts)))
+
+    for parent in {target.parent for _, target in members}:
+        os.makedirs(parent, exist_ok=True)
+    for zi, target in members:
+        with zf.open(zi) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, length=64 * 1024)
+
+
 def safe_extract(src_path: Path, dst_dir: Path) -> list[Path]:
     """
     解压 zip / rar / 7z   → dst_dir
@@ -64,15 +125,20 @@ def safe_extract(src_path: Path, dst_dir: Path) -> list[Path]:
     # ---------- ZIP 使用标准库 ----------
     if suffix == ".zip":
         with zipfile.ZipFile(src_path, "r") as zf:
-            zf.extractall(dst_dir)
+            _extract_zip_members(zf, dst_dir)
 
     # ---------- RAR / 7Z 使用项目内 7‑Zip ----------
     elif suffix in (".rar", ".7z"):
         SevenZ = str(get_sevenz_path())
         cmd = [SevenZ, "x", "-y", str(src_path), f"-o{dst_dir}"]  # x=解压  -y=自动Yes
-        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # 只解压受支持的后缀（-ssc- 忽略大小写），其余条目不解码、不落盘
+        cmd.append("-ssc-")
+        cmd.extend(f"-ir!*.{ext}" for ext in sorted(EXTRACTABLE_EXTS))
+        # 关闭常规输出与进度输出，只收集错误信息，避免缓存整个解压日志
+        cmd.extend(["-bso0", "-bsp0"])
+        res = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         if res.returncode != 0:
-            msg = res.stdout.decode(errors="ignore")
+            msg = res.stderr.decode(errors="ignore")
             raise RuntimeError(f"7‑Zip 解压失败 (code {res.returncode}):\n{msg}")
 
     # ---------- 其它类型 ----------
@@ -84,7 +150,7 @@ def safe_extract(src_path: Path, dst_dir: Path) -> list[Path]:
     for p in dst_dir.rglob("*"):
         if p.is_file():
             ext = p.suffix.lstrip(".").lower()
-            if ext in (SUPPORTED_EXTS - COMPRESS_EXTS):
+            if ext in EXTRACTABLE_EXTS:
                 extracted.append(p)
 
     return extracted
@@ -99,19 +165,19 @@ class OcrError(Exception):
         return f'OcrError:{self.message}'
 
 class OcrTool():
-    def __init__(self, pipeline, page_break_text='\n----- PAGE BREAK -----\n', raise_error=True):
+    def __init__(self, pipeline, page_break_text='\n----- PAGE BREAK -----\n', raise_error=True, pdf_defer_threshold=8,
+                 ocr_cache_maxsize=4096):
         self.pipeline = pipeline
         self.page_break_text = page_break_text
         self.raise_error = raise_error
+        # 文本层 PDF 超过该页数时不在分类时提取，推迟到批量 OCR 启动后再提取，与 GPU 推理重叠
+        self.pdf_defer_threshold = pdf_defer_threshold
+        # 图片 OCR 结果缓存：(图片内容哈希, OCR 参数) -> rec_texts，重复出现的 logo、页眉等图片无需再次识别
+        self._ocr_cache = LRUCache(maxsize=ocr_cache_maxsize) if ocr_cache_maxsize else None
+        # pipeline 由各任务线程共享，PaddleX predict 非线程安全，多任务并发时串行调用
+        self._predict_lock = threading.Lock()
 
-        log_name = 'OCR'
-        logger.add(f"logs/module_{log_name}_{{time:YYYY-MM-DD}}.log",
-               level="INFO",
-               rotation="00:00",
-               filter=lambda record: record["extra"].get("name") == log_name,
-               enqueue=False,
-               buffering=1)
-        self.logger = logger.bind(name=log_name)
+        self.logger = get_module_logger('OCR')
 
     # @staticmethod
     # def is_scanned_pdf(pdf_path):
@@ -122,23 +188,10 @@ class OcrTool():
     #             return True # 没有文本，则可能是扫描版
     #     return False  # 发现可选文本层，说明是电子版
 
-    def read_pdf(self,file_path):
+    def read_pdf(self, file_path):
         try:
-            doc = fitz.open(file_path)
-            page_text_Dict = {}
-
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                text = page.get_text("text")
-                # 清洗文本
-                text = re.sub(r'[ \t\xa0]+', ' ', text)
-                # 先统一换行符为 \n
-                text = re.sub(r'\r\n|\r|\f', '\n', text)
-                # 去除多余的空行，只保留单个换行
-                text = re.sub(r'\n\s*\n', '\n', text)
-                page_text_Dict[page_num + 1] = text
-
-            doc.close()
+            # 逐页提取并清洗（统一空格、换行，去除多余空行）
+            page_text_Dict = read_pdf_pages(file_path)
             self.logger.info(f'fitz 原生提取完成: {file_path}')
             return page_text_Dict
 
@@ -157,20 +210,11 @@ class OcrTool():
                                      use_textline_orientation=False)
             paras.update(kwargs)
 
-            output = self.pipeline.predict(pdf_file, **paras)
-
-            page_text_Dict = {}
-            for index, page in enumerate(output):
-                page_text = '\n'.join(page['rec_texts'])
-
-                # 清洗逻辑：统一空白和换行
-                page_text = re.sub(r'[ \t\xa0]+', ' ', page_text)  # 统一空格类字符为一个空格
-                page_text = re.sub(r'\r\n|\r|\f', '\n', page_text)  # 统一换行符为 \n
-                page_text = re.sub(r'(\n\s*)+', '\n\n', page_text)  # 多个换行/空行合并为段落间空行
+            output = self._predict(pdf_file, paras, pdf_input=True)
 
-                page_num = index + 1
-                page_text_Dict[page_num] = page_text.strip()  # 去头尾空白
-            doc_text = self.page_break_text.join(page_text_Dict[page_num] for page_num in sorted(page_text_Dict.keys()))
+            page_texts = [_clean_pdf_ocr_page(page['rec_texts']) for page in output]
+            doc_text = self.page_break_text.join(page_texts)
+            page_text_Dict = dict(enumerate(page_texts, start=1))
             self.logger.info(f'pdf ocr成功:{file_path}')
             return doc_text, page_text_Dict
         except Exception as e:
@@ -178,8 +222,6 @@ class OcrTool():
             self.logger.exception(e)
             if self.raise_error:
                 raise OcrError(f'pdf ocr失败')
-        finally:
-            paddle.device.cuda.empty_cache()
 
     def image_ocr(self, file_input, **kwargs):
         try:
@@ -190,42 +232,30 @@ class OcrTool():
             )
             paras.update(kwargs)
 
-            page_text_Dict = {}
-
             if isinstance(file_input, Image.Image):
                 # 单张 PIL 图像
-                img = np.array(file_input.convert("RGB"))[:, :, ::-1]
-                output = self.pipeline.predict(img, **paras)
-                page_text = '\n'.join(output['rec_texts'])
-                page_text_Dict[1] = re.sub(r'\s+', '\n', page_text)
-                doc_text = page_text_Dict[1]
-                return doc_text, page_text_Dict
-
-            # 如果是文件路径或路径列表
-            image_file = to_list(file_input)
-            image_file = [Path(file).as_posix() for file in image_file]
-            images = [np.array(Image.open(file).convert('RGB'))[:, :, ::-1] for file in image_file]
-
-            output = self.pipeline.predict(images, **paras)
+                if file_input.mode != "RGB":  # 已是 RGB 时 convert 仍会整图复制一份
+                    file_input = file_input.convert("RGB")
+                img = np.ascontiguousarray(np.array(file_input)[:, :, ::-1])
+                output = self._predict(img, paras)[0]
+                doc_text = _collapse_ws('\n'.join(output['rec_texts']))
+                return doc_text, {1: doc_text}
 
-            for index, page in enumerate(output):
-                page_text = '\n'.join(page['rec_texts'])
-                page_num = index + 1
-                page_text_Dict[page_num] = re.sub('\s+', '\n', page_text)
+            # 如果是文件路径、图片字节或其列表
+            image_file = to_list(file_input)
+            image_file = [file if isinstance(file, bytes) else Path(file).as_posix() for file in image_file]
 
-            doc_text = self.page_break_text.join(
-                page_text_Dict[page_num] for page_num in sorted(page_text_Dict.keys())
-            )
+            page_texts = [_clean_image_ocr_page(rec_texts) for rec_texts in self._predict_images(image_file, paras)]
+            doc_text = self.page_break_text.join(page_texts)
+            page_text_Dict = dict(enumerate(page_texts, start=1))
 
-            self.logger.info(f'image ocr成功:{file_input}')
+            self.logger.info(f'image ocr成功:{_describe_images(file_input)}')
             return doc_text, page_text_Dict
 
         except Exception as e:
-            self.logger.error(f'image ocr失败:{file_input}')
+            self.logger.error(f'image ocr失败:{_describe_images(file_input)}')
             self.logger.exception(e)
             raise OcrError(f'image ocr失败')
-        finally:
-            paddle.device.cuda.empty_cache()
 
     def read_txt(self, file_path):
         try:
@@ -236,8 +266,7 @@ class OcrTool():
                     text_List.append(f.read())
             doc_text = self.page_break_text.join(text_List)
 
-            page_text_List = doc_text.split(self.page_break_text)
-            page_text_Dict = dict(zip(range(1, len(page_text_List) + 1), page_text_List))
+            page_text_Dict = dict(enumerate(doc_text.split(self.page_break_text), start=1))
             self.logger.info(f'txt解析成功:{file_path}')
             return doc_text, page_text_Dict
         except Exception as e:
@@ -275,34 +304,170 @@ class OcrTool():
             doc_text = self.page_break_text.join(para_texts)
             return doc_text, {1: doc_text}
 
-        # 2) 提取图片
-        tmp_dir = Path(tempfile.mkdtemp(prefix="docx_img_"))
-        image_files: list[Path] = []
+        # 2) 提取图片：直接取内存中的图片字节交给 OCR，不再写临时文件
+        # 重复图片仍按出现位置保留一页，OCR 时由 _predict_images 按内容去重，只识别一次
+        image_blobs = [rel.target_part.blob for rel in doc.part.rels.values()
+                       if rel.reltype == RT.IMAGE]  # ★ 关键：官方常量判断
+
+        if not image_blobs:
+            # 无图仍返回原文本
+            doc_text = self.page_break_text.join(para_texts)
+            return doc_text, {1: doc_text}
+
+        # 3) OCR
+        ocr_text, page_dict = self.image_ocr(image_blobs)
+        return ocr_text, page_dict
+
+
+    def _pdf_needs_ocr(self, doc):
+        """前 3 页有效字符少或水印占比高时，整个 PDF 走 OCR；doc 为已打开的 fitz.Document"""
+        pages_to_check = min(3, doc.page_count)
+        merged_txt = ""
+        eff_len = 0
+        for pg in range(pages_to_check):
+            pg_txt = doc[pg].get_text("text")
+            merged_txt += pg_txt + "\n"
+            eff_len += count_effective_chars(pg_txt)
+
+        watermark_heavy = is_watermark_dominated(merged_txt, top_rate=0.5)
+
+        # 同时满足「有效字符少」或「水印占比高」就 OCR
+        return (eff_len < 60) or watermark_heavy
+
+    def _read_text_pdf(self, file_path):
+        """文本层 PDF 直接提取，返回 (doc_text, page_text_Dict)；file_path 可为已打开的 fitz.Document"""
         try:
-            for rel in doc.part.rels.values():
-                if rel.reltype == RT.IMAGE:  # ★ 关键：官方常量判断
-                    img_bytes = rel.target_part.blob
-                    name = Path(rel.target_ref).name or "image"
-                    out = tmp_dir / name
-                    idx = 1
-                    while out.exists():
-                        out = tmp_dir / f"{out.stem}_{idx}{out.suffix}"
-                        idx += 1
-                    with open(out, "wb") as f:
-                        f.write(img_bytes)
-                    image_files.append(out)
-
-            if not image_files:
-                # 无图仍返回原文本
-                doc_text = self.page_break_text.join(para_texts)
-                return doc_text, {1: doc_text}
+            page_text_Dict = self.read_pdf(file_path)
+            # read_pdf_pages 按页码顺序插入，直接按插入顺序拼接
+            doc_text = self.page_break_text.join(page_text_Dict.values())
+            self.logger.info(f'pdf逐页混合处理完成:{file_path}')
+            return doc_text, page_text_Dict
+        except Exception as e:
+            self.logger.error(f'pdf处理失败:{file_path}')
+            self.logger.exception(e)
+            if self.raise_error:
+                raise OcrError(f'pdf处理失败')
+            return '', {}
 
-            # 3) OCR
-            ocr_text, page_dict = self.image_ocr(image_files)
-            return ocr_text, page_dict
+    def _image_cache_key(self, data, paras):
+        return _hash_bytes(data), tuple(sorted(paras.items()))
+
+    def _lookup_images(self, image_files, paras):
+        """
+        读取图片（文件路径或图片字节）并查 OCR 缓存，返回 (results, pending, miss_images)：
+        results 与输入等长，命中缓存的位置已填入 rec_texts；
+        pending 为 {缓存键: [需要该结果的输入序号]}，与 miss_images（待识别的解码图片）按顺序一一对应，
+        同一批中内容相同的图片只解码、识别一次。
+        """
+        results = [None] * len(image_files)
+        pending = {}
+        miss_images = []
+        for i, file in enumerate(image_files):
+            if isinstance(file, bytes):
+                data = file
+            else:
+                with open(file, 'rb') as f:
+                    data = f.read()
+            key = self._image_cache_key(data, paras)
+            rec_texts = self._ocr_cache.get(key) if self._ocr_cache is not None else None
+            if rec_texts is not None:
+                results[i] = rec_texts
+            elif key in pending:
+                pending[key].append(i)
+            else:
+                pending[key] = [i]
+                miss_images.append(_decode_image(data))
+        return results, pending, miss_images
+
+    def _store_images(self, results, pending, output):
+        """把 miss_images 的识别结果写入缓存，并填回 results 中所有需要它的位置"""
+        for (key, indexes), page in zip(pending.items(), output):
+            rec_texts = list(page['rec_texts'])
+            if self._ocr_cache is not None:
+                self._ocr_cache.set(key, rec_texts)
+            for i in indexes:
+                results[i] = rec_texts
+
+    def _predict_images(self, image_files, paras):
+        """
+        批量识别图片（文件路径或图片字节），返回与输入顺序一致的 rec_texts 列表；
+        命中缓存的图片不再送入 pipeline，同一批中内容相同的图片只识别一次。
+        """
+        results, pending, miss_images = self._lookup_images(image_files, paras)
+        if miss_images:
+            self._store_images(results, pending, self._predict(miss_images, paras))
+        return results
+
+    def _predict(self, inputs, paras, pdf_input=False):
+        """
+        调用 pipeline.predict 并取出全部结果，整个调用持有 _predict_lock。
+        inputs 含 PDF 时，PaddleX 逐页用 fitz 读取、渲染，每取一页持有 FITZ_LOCK，与其他线程的 fitz 调用互斥。
+        """
+        with self._predict_lock:
+            output = self.pipeline.predict(inputs, **paras)
+            return list(fitz_locked(output) if pdf_input else output)
+
+    def _ocr_batch(self, batch, **kwargs):
+        """
+        将多个文件（需 OCR 的 PDF 与图片）合并为一次 pipeline.predict 调用，再按各文件页数切分结果。
+        :param batch: [(序号, 'pdf' | 'image', 文件路径, 页数)]
+        :return: {序号: (doc_text, page_text_Dict)}
+        批量调用失败时回退为逐个文件调用 pdf_ocr / image_ocr。
+        """
+        paras = dict(
+            text_det_box_thresh=0.4,
+            text_det_unclip_ratio=1.5,
+            use_textline_orientation=False
+        )
+        paras.update(kwargs)
+
+        try:
+            pdf_items = [(file_path, page_count) for _, kind, file_path, page_count in batch if kind == 'pdf']
+            image_indexes = [index for index, kind, _, _ in batch if kind == 'image']
+            # 图片先查缓存，未命中且内容不同的图片才送入 pipeline
+            image_results, pending, miss_images = self._lookup_images(
+                [file_path for _, kind, file_path, _ in batch if kind == 'image'], paras)
+            # PDF 页数在分类阶段已取得，此处不再打开 PDF
+            inputs = [Path(file_path).as_posix() for file_path, _ in pdf_items] + miss_images
+
+            output = self._predict(inputs, paras, pdf_input=bool(pdf_items)) if inputs else []
+            pdf_pages = sum(page_count for _, page_count in pdf_items)
+            if len(output) != pdf_pages + len(miss_images):
+                raise OcrError(f'批量 OCR 结果页数不符: {len(output)} != {pdf_pages + len(miss_images)}')
+            self._store_images(image_results, pending, output[pdf_pages:])
+        except Exception as e:
+            self.logger.warning(f'批量 OCR 失败，改为逐个文件 OCR: {e}')
+            return {
+                index: (self.pdf_ocr(file_path) if kind == 'pdf' else self.image_ocr(file_path)) or ('', {})
+                for index, kind, file_path, _ in batch
+            }
+
+        image_texts = dict(zip(image_indexes, image_results))
+        results = {}
+        start = 0
+        for index, kind, file_path, page_count in batch:
+            if kind == 'pdf':
+                pages = output[start:start + page_count]
+                start += page_count
+            try:
+                if kind == 'pdf':
+                    pages_texts = [list(page['rec_texts']) for page in pages]
+                else:
+                    pages_texts = [image_texts[index]]
+                clean = _clean_pdf_ocr_page if kind == 'pdf' else _clean_image_ocr_page
+                page_texts = [clean(rec_texts) for rec_texts in pages_texts]
+                doc_text = self.page_break_text.join(page_texts)
+                page_text_Dict = dict(enumerate(page_texts, start=1))
+                results[index] = (doc_text, page_text_Dict)
+                self.logger.info(f'{kind} ocr成功:{file_path}')
+            except Exception as e:
+                self.logger.error(f'{kind} ocr失败:{file_path}')
+                self.logger.exception(e)
+                if kind == 'image' or self.raise_error:
+                    raise OcrError(f'{kind} ocr失败')
+                results[index] = ('', {})
+        return results
 
-        finally:
-            shutil.rmtree(tmp_dir, ignore_errors=True)
     def ocr_files(self, file_path_List):
         file_path_List = to_list(file_path_List)
         file_path_List = [Path(file_path) for file_path in file_path_List]
@@ -323,91 +488,163 @@ class OcrTool():
         # 把解压得到的文件追加到待处理列表
         file_path_List.extend(extra_files)
 
-
-        all_text = ''
+        # 第一轮：按类型分类。需要 OCR 的 PDF 与图片收集起来，之后合并为一次 OCR 调用
+        file_results = {}
+        ocr_batch = []
+        text_pdfs = []  # [(序号, 文件路径)]
+        txt_files = []
+        docx_files = []
         for index, file_path in enumerate(file_path_List):
             suffix = file_path.suffix.lstrip('.').lower()
             self.logger.info(f'{suffix=}')
-            doc_text = ''
-            page_text_Dict = {}
             if suffix == 'pdf':
-                try:
-                    doc = fitz.open(file_path)
-
-                    pages_to_check = min(3, len(doc))
-                    merged_txt = ""
-                    eff_len = 0
-                    for pg in range(pages_to_check):
-                        pg_txt = doc[pg].get_text("text")
-                        merged_txt += pg_txt + "\n"
-                        eff_len += count_effective_chars(pg_txt)
-
-                    watermark_heavy = is_watermark_dominated(merged_txt, top_rate=0.5)
-
-                    # 同时满足「有效字符少」或「水印占比高」就 OCR
-                    use_ocr_for_all = (eff_len < 60) or watermark_heavy
-                    # ---------------------------
-
-                    # first_page = doc[0]
-                    # text = re.sub(r'[ \t\xa0]+', ' ', first_page.get_text("text"))
-                    # text = re.sub(r'\n{2,}', '\n', text).strip()
-                    # use_ocr_for_all = len(text) < 10
-
-                    if use_ocr_for_all:
-                        self.logger.info(f"第 1 页字符太少，使用 OCR 处理整个文件")
-                        doc_text, page_text_Dict = self.pdf_ocr(file_path)
+                doc = None
+                with FITZ_LOCK:  # 与其他线程（如后台印章识别）的 fitz 调用互斥
+                    try:
+                        doc = fitz.open(file_path)
+                        needs_ocr = self._pdf_needs_ocr(doc)
+                    except Exception as e:
+                        self.logger.error(f'pdf处理失败:{file_path}')
+                        self.logger.exception(e)
+                        if self.raise_error:
+                            raise OcrError(f'pdf处理失败')
+                        file_results[index] = ('', {})
                     else:
-                        self.logger.info(f"第 1 页文本正常，使用 fitz 原生提取整个文件")
-                        page_text_Dict = self.read_pdf(file_path)
-                        doc_text = self.page_break_text.join(
-                            page_text_Dict[p] for p in sorted(page_text_Dict.keys())
-                        )
-
-                    doc.close()
-                    doc_text = self.page_break_text.join(
-                        page_text_Dict[page_num] for page_num in sorted(page_text_Dict.keys()))
-                    self.logger.info(f'pdf逐页混合处理完成:{file_path}')
-                except Exception as e:
-                    self.logger.error(f'pdf处理失败:{file_path}')
-                    self.logger.exception(e)
-                    if self.raise_error:
-                        raise OcrError(f'pdf处理失败')
+                        page_count = doc.page_count
+                        if needs_ocr:
+                            self.logger.info(f"第 1 页字符太少，使用 OCR 处理整个文件")
+                            ocr_batch.append((index, 'pdf', file_path, page_count))
+                        elif page_count <= self.pdf_defer_threshold:
+                            # 页数少的文本层 PDF 直接用判断时已打开的文档提取，不再重新打开解析
+                            self.logger.info(f"第 1 页文本正常，使用 fitz 原生提取整个文件")
+                            file_results[index] = self._read_text_pdf(doc)
+                        else:
+                            self.logger.info(f"第 1 页文本正常，使用 fitz 原生提取整个文件")
+                            text_pdfs.append((index, file_path))
+                    finally:
+                        if doc is not None:
+                            doc.close()
             elif suffix in ('jpg','jpeg','png'):
-                doc_text, page_text_Dict = self.image_ocr(file_path)
+                ocr_batch.append((index, 'image', file_path, 1))
             elif suffix == 'txt':
-                doc_text, page_text_Dict = self.read_txt(file_path)
+                txt_files.append((index, file_path))
             elif suffix  in ('docx', 'doc'):
-                doc_text, page_text_Dict = self.read_docx(file_path)
+                docx_files.append((index, file_path))
             else:
                 self.logger.error(f'{file_path}的类型无法处理')
+                file_results[index] = ('', {})
 
-            if all_text:
-                all_text += self.page_break_text + doc_text
-            else:
-                all_text = doc_text
-        page_text_List = all_text.split(self.page_break_text)
-        page_text_Dict = dict(zip(range(1, len(page_text_List) + 1), page_text_List))
+        # 第二轮：需 OCR 的文件在后台线程一次送入 pipeline，当前线程同时解析文本层 PDF 与 txt，
+        # 使 GPU 推理与 CPU/IO 解析重叠。页数较多的文本层 PDF 推迟到此处提取。后台线程中 PaddleX 同样用 fitz
+        # 读取 PDF 输入，两边都持有 FITZ_LOCK：后台线程每取一页加锁一次，当前线程每提取一个文件加锁一次
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                ocr_future = executor.submit(self._ocr_batch, ocr_batch) if ocr_batch else None
+                for index, file_path in text_pdfs:
+                    with FITZ_LOCK:
+                        file_results[index] = self._read_text_pdf(file_path)
+                for index, file_path in txt_files:
+                    file_results[index] = self.read_txt(file_path) or ('', {})
+                if ocr_future is not None:
+                    file_results.update(ocr_future.result())
+
+            # docx 内嵌图片会调用 pipeline，须在批量 OCR 结束后处理
+            for index, file_path in docx_files:
+                file_results[index] = self.read_docx(file_path) or ('', {})
+        finally:
+            # 整批文件处理完后释放一次显存缓存，而不是每个文件各释放一次
+            if ocr_batch or docx_files:
+                _empty_gpu_cache()
+
+        # 按文件顺序拼接；开头的空文本不产生分页符（与逐个累加时的行为一致）
+        doc_texts = [file_results[index][0] for index in range(len(file_path_List))]
+        first = next((i for i, doc_text in enumerate(doc_texts) if doc_text), len(doc_texts))
+        all_text = self.page_break_text.join(doc_texts[first:])
+        page_text_Dict = dict(enumerate(all_text.split(self.page_break_text), start=1))
         return all_text, page_text_Dict
 
     def get_duplicate_line(self, lines, most_common=30, min_length=5, min_count=10):
-        line_counter = Counter(lines)
-        duplicate_line_List = [line for line,count in line_counter.most_common(most_common) if len(line) >= min_length and count >= min_count
+        # 过短的行不会被判为重复行，计数前先过滤，减少 Counter 插入量，也不再占用 most_common 名额
+        line_counter = Counter(line for line in lines if len(line) >= min_length)
+        duplicate_line_List = [line for line,count in line_counter.most_common(most_common) if count >= min_count
                                ]
 
         return [line for line in duplicate_line_List if line.strip() != self.page_break_text.strip()]
 
     def remove_duplicate_sentences(self, doc_text, page_text_Dict, **kwargs):
         lines = doc_text.split('\n')
-        duplicate_line_List = self.get_duplicate_line(lines, **kwargs)
-        lines = [line for line in lines if line not in duplicate_line_List]
-        doc_text = '\n'.join(lines)
-        for page_num in page_text_Dict:
-            page_text_Dict[page_num] = '\n'.join([line for line in page_text_Dict[page_num].split('\n') if line not in duplicate_line_List])
+        duplicate_line_Set = set(self.get_duplicate_line(lines, **kwargs))
+        if not duplicate_line_Set:
+            return doc_text, page_text_Dict
+        doc_text = '\n'.join([line for line in lines if line not in duplicate_line_Set])
+        page_text_Dict.update({
+            page_num: '\n'.join([line for line in page_text.split('\n') if line not in duplicate_line_Set])
+            for page_num, page_text in page_text_Dict.items()
+        })
         return doc_text, page_text_Dict
+
+
+def _empty_gpu_cache():
+    """释放 paddle 的 GPU 显存缓存"""
+    paddle.device.cuda.empty_cache()
+
+def _describe_images(file_input) -> str:
+    """日志用：图片字节只记录大小，避免把二进制内容写进日志"""
+    if isinstance(file_input, (list, tuple)):
+        return str([f'<{len(f)} bytes>' if isinstance(f, bytes) else str(f) for f in file_input])
+    return f'<{len(file_input)} bytes>' if isinstance(file_input, bytes) else str(file_input)
+
+def _hash_bytes(data: bytes) -> bytes:
+    """图片内容哈希，用作 OCR 缓存键"""
+    if xxhash is not None:
+        return xxhash.xxh3_128_digest(data)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def _decode_image(data: bytes) -> np.ndarray:
+    """
+    图片字节解码为 pipeline 需要的 BGR 数组。
+    优先用 cv2 直接解码为连续的 BGR uint8（忽略 EXIF 方向，与 PIL 结果一致），省去 RGB→BGR 的额外拷贝；
+    cv2 不可用或无法解码时回退到 PIL。
+    """
+    if cv2 is not None:
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if img is not None:
+            return img
+    img = Image.open(io.BytesIO(data))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return np.ascontiguousarray(np.array(img)[:, :, ::-1])
+
+def _clean_pdf_ocr_page(rec_texts) -> str:
+    """PDF OCR 单页结果转文本：统一空白和换行，多个空行合并为段落间空行"""
+    page_text = '\n'.join(rec_texts)
+    page_text = normalize_ws(page_text)  # 统一空格类字符为一个空格，换行符为 \n
+    page_text = _RE_PARAGRAPH.sub('\n\n', page_text)  # 多个换行/空行合并为段落间空行
+    return page_text.strip()  # 去头尾空白
+
+def _collapse_ws(text: str) -> str:
+    """
+    将每段连续空白替换为一个换行，结果与 re.sub(r'\s+', '\n', text) 一致；
+    str.split 在 C 层按 Unicode 空白切分（含全角空格），比正则替换快约 3 倍。
+    """
+    parts = text.split()
+    if not parts:
+        return '\n' if text else ''
+    collapsed = '\n'.join(parts)
+    if text[0].isspace():
+        collapsed = '\n' + collapsed
+    if text[-1].isspace():
+        collapsed += '\n'
+    return collapsed
+
+def _clean_image_ocr_page(rec_texts) -> str:
+    """图片 OCR 单页结果转文本：空白统一为换行"""
+    return _collapse_ws('\n'.join(rec_texts))
+
 def count_effective_chars(txt: str) -> int:
     """
     仅保留中文、英文、数字作为“有效字符”
     """
-    txt = re.sub(r'[\s\r\n\t\xa0]+', '', txt)           # 去空白
-    txt = re.sub(r'[^\w\u4e00-\u9fa5]', '', txt)        # 去符号（保留字母数字中文）
+    txt = _RE_EFF_WS.sub('', txt)           # 去空白
+    txt = _RE_EFF_SYM.sub('', txt)        # 去符号（保留字母数字中文）
     return len(txt)
\ No newline at end of file
@@ -1,16 +1,25 @@
 # module/ocrvl.py
 from __future__ import annotations
+import os
 import re
 import shlex
 import subprocess
 import tempfile
 import shutil
 import json
+import threading
 from pathlib import Path
 from collections import Counter
 from typing import List, Dict, Tuple, Optional
-from loguru import logger
 
+from module.utils import get_module_logger
+from module.pdf_text import fitz_locked
+
+# 去掉 markdown 中的图片引用
+_RE_IMG_MD = re.compile(r"!\[[^\]]*\]\([^)]+\)")
+# 子进程方式的临时输出放到内存文件系统（Linux /dev/shm），读完即删，不产生磁盘 IO
+_SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+_IMAGE_EXTS = {".png", ".jpg", ".jpeg"}
 
 class OcrError(Exception):
     def __init__(self, message: str):
@@ -23,7 +32,8 @@ class OcrError(Exception):
 
 class OcrVL:
     """
-    调用 PaddleOCR 的 `doc_parser` 子命令，后端连接 vLLM(OpenAI 兼容) 的 PaddleOCR-VL 服务。
+    调用 PaddleOCR 的 doc_parser（PaddleOCRVL 产线），后端连接 vLLM(OpenAI 兼容) 的 PaddleOCR-VL 服务。
+    优先在进程内常驻一个 PaddleOCRVL 实例；paddleocr 不可导入或初始化失败时回退为逐文件调用 `paddleocr doc_parser` 子命令。
     对外 API 与原 OcrTool 对齐：
       - 属性：page_break_text
       - 方法：ocr_files(paths) -> (doc_text, page_text_dict)
@@ -66,16 +76,29 @@ class OcrVL:
         self.save_images = bool(save_images)
         self.save_layout_png = bool(save_layout_png)
 
-        log_name = "OCR-VL"
-        logger.add(
-            f"logs/module_{log_name}_{{time:YYYY-MM-DD}}.log",
-            level="INFO",
-            rotation="00:00",
-            filter=lambda record: record["extra"].get("name") == log_name,
-            enqueue=False,
-            buffering=1,
-        )
-        self._log = logger.bind(name=log_name)
+        self._log = get_module_logger("OCR-VL")
+
+        # 进程内 doc_parser：模型只加载一次；预测非线程安全，多任务并发时串行调用
+        self._parser = self._init_parser()
+        self._parser_lock = threading.Lock()
+
+    def _init_parser(self):
+        try:
+            from paddleocr import PaddleOCRVL
+        except ImportError:
+            self._log.warning("[doc_parser] 无法导入 paddleocr.PaddleOCRVL，回退为子进程调用")
+            return None
+        try:
+            parser = PaddleOCRVL(
+                vl_rec_backend=self.backend,
+                vl_rec_server_url=self.server_url,
+                vl_rec_model_name=self.model_name,
+            )
+        except Exception as e:
+            self._log.warning(f"[doc_parser] PaddleOCRVL 初始化失败，回退为子进程调用：{e}")
+            return None
+        self._log.info("[doc_parser] 使用进程内 PaddleOCRVL")
+        return parser
 
     # --------- public API (兼容 OcrTool) ---------
     def ocr_files(self, file_path_list: List[Path | str]) -> Tuple[str, Dict[int, str]]:
@@ -100,12 +123,15 @@ class OcrVL:
                     continue
 
             # 确定此次输出目录：
-            # - save_mode=none 时，使用临时目录（读取后整目录删除）
+            # - save_mode=none 时：进程内调用直接在内存中取结果，不落盘；
+            #   子进程调用必须落盘，使用临时目录（读取后整目录删除）
             # - 其他模式：save_root/文件名去后缀
             temp_dir_obj: Optional[tempfile.TemporaryDirectory] = None
+            save_dir: Optional[Path] = None
             if self.save_mode == "none" or self.save_root is None:
-                temp_dir_obj = tempfile.TemporaryDirectory(prefix="ocrvl_")
-                save_dir = Path(temp_dir_obj.name)
+                if self._parser is None:
+                    temp_dir_obj = tempfile.TemporaryDirectory(prefix="ocrvl_", dir=_SHM_DIR)
+                    save_dir = Path(temp_dir_obj.name)
             else:
                 save_dir = (self.save_root / f.stem).resolve()
                 save_dir.mkdir(parents=True, exist_ok=True)
@@ -115,10 +141,11 @@ class OcrVL:
                 merged_md, md_pages = self._run_doc_parser(f, save_dir)
             finally:
                 # 清理/裁剪输出（根据开关）
-                try:
-                    self._postprocess_outputs(save_dir)
-                except Exception as ce:
-                    self._log.warning(f"[cleanup] 清理输出文件时出现非致命异常：{ce}")
+                if save_dir is not None:
+                    try:
+                        self._postprocess_outputs(save_dir)
+                    except Exception as ce:
+                        self._log.warning(f"[cleanup] 清理输出文件时出现非致命异常：{ce}")
 
             # 合并内存结果
             all_doc = (all_doc + self.page_break_text + merged_md) if all_doc else merged_md
@@ -146,35 +173,78 @@ class OcrVL:
         去掉频繁重复的行（如水印/页眉页脚）。
         """
         lines = doc_text.split("\n")
-        dups = self._get_duplicate_lines(lines, most_common, min_length, min_count)
+        dups = set(self._get_duplicate_lines(lines, most_common, min_length, min_count))
         if dups:
-            lines = [ln for ln in lines if ln not in dups]
-            doc_text = "\n".join(lines)
-            for k in list(page_text_dict.keys()):
-                p_lines = page_text_dict[k].split("\n")
-                page_text_dict[k] = "\n".join([ln for ln in p_lines if ln not in dups])
+            doc_text = "\n".join([ln for ln in lines if ln not in dups])
+            page_text_dict.update({
+                k: "\n".join([ln for ln in txt.split("\n") if ln not in dups])
+                for k, txt in page_text_dict.items()
+            })
         return doc_text, page_text_dict
 
     # --------- internal helpers ---------
-    def _run_doc_parser(self, input_path: Path, save_dir: Path) -> Tuple[str, Dict[int, str]]:
+    def _run_doc_parser(self, input_path: Path, save_dir: Optional[Path]) -> Tuple[str, Dict[int, str]]:
         """
-        调用 `paddleocr doc_parser`，收集 save_dir 下的所有 .md 合并。
+        调用 doc_parser，按页返回 markdown；save_dir 为 None 时不落盘（仅进程内调用）。
         """
-        save_dir.mkdir(parents=True, exist_ok=True)
+        if self._parser is not None:
+            return self._predict_in_process(input_path, save_dir)
+        return self._run_doc_parser_subprocess(input_path, save_dir)
 
-        cmd = f"""
-        paddleocr doc_parser \
-          --input {shlex.quote(str(input_path))} \
-          --save_path {shlex.quote(str(save_dir))} \
-          --vl_rec_backend {self.backend} \
-          --vl_rec_server_url {shlex.quote(self.server_url)} \
-          --vl_rec_model_name {shlex.quote(self.model_name)}
+    def _merge_pages(self, md_texts: List[str]) -> Tuple[str, Dict[int, str]]:
+        merged_md = ""
+        page_map: Dict[int, str] = {}
+        for i, txt in enumerate(md_texts, start=1):
+            # 去图片标记，减少 tokens
+            txt = _RE_IMG_MD.sub("", txt)
+            # 合并
+            merged_md += (self.page_break_text if merged_md else "") + txt.strip()
+            page_map[i] = txt
+        return merged_md, page_map
+
+    def _predict_in_process(self, input_path: Path, save_dir: Optional[Path]) -> Tuple[str, Dict[int, str]]:
+        """
+        使用常驻的 PaddleOCRVL 实例预测，每页结果直接从内存读取 markdown。
+        """
+        self._log.info(f"[doc_parser] predict {input_path}")
+        try:
+            with self._parser_lock:
+                results = list(fitz_locked(self._parser.predict(str(input_path))))
+        except Exception as e:
+            self._log.error(f"[doc_parser] 失败：{e}")
+            raise OcrError("paddleocr doc_parser 调用失败")
+
+        md_texts = []
+        for res in results:
+            md_texts.append(res.markdown.get("markdown_texts", "") or "")
+            if save_dir is not None:
+                if self.save_mode in {"md", "all"}:
+                    res.save_to_markdown(save_path=str(save_dir))
+                if self.save_mode in {"json", "all"}:
+                    res.save_to_json(save_path=str(save_dir))
+        if not md_texts:
+            raise OcrError("doc_parser 未产出 markdown")
+        self._log.info(f"[doc_parser] 完成，共 {len(md_texts)} 页")
+        return self._merge_pages(md_texts)
+
+    def _run_doc_parser_subprocess(self, input_path: Path, save_dir: Path) -> Tuple[str, Dict[int, str]]:
         """
-        # 规整空白
-        cmd = " ".join(cmd.split())
-        self._log.info(f"[doc_parser] {cmd}")
+        调用 `paddleocr doc_parser` 子命令，收集 save_dir 下的所有 .md 合并。
+        """
+        save_dir.mkdir(parents=True, exist_ok=True)
 
-        res = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # 直接传 argv，不经 /bin/sh：少一次 fork/exec，参数也无需转义
+        argv = [
+            "paddleocr", "doc_parser",
+            "--input", str(input_path),
+            "--save_path", str(save_dir),
+            "--vl_rec_backend", str(self.backend),
+            "--vl_rec_server_url", str(self.server_url),
+            "--vl_rec_model_name", str(self.model_name),
+        ]
+        self._log.info(f"[doc_parser] {shlex.join(argv)}")
+
+        res = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
         out = res.stdout.decode(errors="ignore")
         if res.returncode != 0:
             self._log.error(f"[doc_parser] 失败 rc={res.returncode}\n{out}")
@@ -186,17 +256,7 @@ class OcrVL:
         if not md_files:
             raise OcrError("doc_parser 未生成 .md 文件")
 
-        merged_md = ""
-        page_map: Dict[int, str] = {}
-        for i, md in enumerate(md_files, start=1):
-            txt = md.read_text(encoding="utf-8", errors="ignore")
-            # 去图片标记，减少 tokens
-            txt = re.sub(r"!\[[^\]]*\]\([^)]+\)", "", txt)
-            # 合并
-            merged_md += (self.page_break_text if merged_md else "") + txt.strip()
-            page_map[i] = txt
-
-        return merged_md, page_map
+        return self._merge_pages([md.read_text(encoding="utf-8", errors="ignore") for md in md_files])
 
     def _postprocess_outputs(self, save_dir: Path) -> None:
         """
@@ -217,88 +277,51 @@ class OcrVL:
                 pass
             return
 
-        # 想要保留的扩展名
-        keep_exts: set[str] = set()
-        if self.save_mode == "md":
-            keep_exts = {".md"}
-        elif self.save_mode == "json":
-            # 只保留 *_res.json（其余 json 删除）
-            keep_exts = {".json"}
-        elif self.save_mode == "all":
-            # 全部保留，但后面会根据开关剔除图片
-            keep_exts = set()
-
-        # 1) 遍历删除不想要的文件类型
+        # 单次遍历输出目录：先分出文件与目录，再逐个判断文件是否保留
+        files: List[Path] = []
+        dirs: List[Path] = []
         for p in save_dir.rglob("*"):
-            if not p.is_file():
-                continue
-            suffix = p.suffix.lower()
+            (dirs if p.is_dir() else files).append(p)
 
-            # 只保留 md/json 时的通用剔除
-            if self.save_mode in {"md", "json"}:
-                if suffix not in keep_exts:
-                    try:
-                        p.unlink(missing_ok=True)
-                    except Exception:
-                        pass
-                    continue
+        for p in files:
+            if not self._keep_output(p):
+                try:
+                    os.unlink(p)
+                except OSError:
+                    pass
 
-                # json 模式下，仅保留 *_res.json
-                if self.save_mode == "json" and suffix == ".json":
-                    if not p.name.endswith("_res.json"):
-                        try:
-                            p.unlink(missing_ok=True)
-                        except Exception:
-                            pass
-                    continue
+        # 清理空目录（由深到浅；非空目录 rmdir 会失败，直接跳过）
+        for d in sorted(dirs, key=lambda x: len(x.parts), reverse=True):
+            try:
+                d.rmdir()
+            except OSError:
+                pass
 
-            # all 模式：稍后处理图片剔除
-            # md/json 模式走到这里说明当前文件是保留对象（上面已删掉其它）
-
-        # 2) 处理图片剔除（对 all / json / md 都生效）
-        #    - save_images=False 时，删除普通页图（.png/.jpg）
-        #    - save_layout_png=False 时，删除 layout 可视化 PNG（命名包含 "_layout_"）
-        for p in list(save_dir.rglob("*")):
-            if not p.is_file():
-                continue
-            name = p.name.lower()
-            suffix = p.suffix.lower()
-
-            # 常见图片
-            if suffix in {".png", ".jpg", ".jpeg"}:
-                # layout 可视化
-                if ("_layout_" in name or "layout_det_res" in name or "layout_order_res" in name):
-                    if not self.save_layout_png:
-                        try:
-                            p.unlink(missing_ok=True)
-                        except Exception:
-                            pass
-                else:
-                    # 普通页图
-                    if not self.save_images:
-                        try:
-                            p.unlink(missing_ok=True)
-                        except Exception:
-                            pass
-
-        # 3) 清理空目录
-        for d in sorted(save_dir.rglob("*"), key=lambda x: len(str(x)), reverse=True):
-            if d.is_dir():
-                try:
-                    next(d.iterdir())
-                except StopIteration:
-                    # 空目录
-                    try:
-                        d.rmdir()
-                    except Exception:
-                        pass
+    def _keep_output(self, p: Path) -> bool:
+        """
+        判断输出文件是否保留：
+        - md / json 模式：仅保留 .md / *_res.json
+        - 图片（对所有模式生效）：layout 可视化 PNG 受 save_layout_png 控制，普通页图受 save_images 控制
+        """
+        name = p.name.lower()
+        suffix = p.suffix.lower()
+        if self.save_mode == "md":
+            return suffix == ".md"
+        if self.save_mode == "json":
+            return suffix == ".json" and p.name.endswith("_res.json")
+        if suffix in _IMAGE_EXTS:
+            if "_layout_" in name or "layout_det_res" in name or "layout_order_res" in name:
+                return self.save_layout_png
+            return self.save_images
+        return True
 
     def _get_duplicate_lines(
         self, lines: List[str], most_common: int, min_length: int, min_count: int
     ) -> List[str]:
-        cnt = Counter([ln for ln in lines if ln.strip()])
+        # 过短的行不会被判为重复行，计数前先过滤，也不再占用 most_common 名额
+        cnt = Counter(ln for ln in lines if len(ln) >= min_length and ln.strip())
         dups = [
             ln for ln, c in cnt.most_common(most_common)
-            if len(ln) >= min_length and c >= min_count and ln.strip() != self.page_break_text.strip()
+            if c >= min_count and ln.strip() != self.page_break_text.strip()
         ]
         return dups
@@ -0,0 +1,69 @@
+# module/pdf_text.py
+"""
+PDF 文本层提取：逐页 get_text + 清洗，在当前进程顺序执行。
+不使用进程池：spawn 子进程会重新导入入口脚本 main.py，重复初始化日志 sink 并加载 fastapi/transformers/paddlex。
+"""
+import re
+import threading
+
+import fitz
+
+# 空格类字符连续段；单个普通空格替换后不变，不去匹配，可省去绝大多数替换
+_RE_WS = re.compile(r' [ \t\xa0]+|[\t\xa0][ \t\xa0]*')
+_RE_BLANKLINES = re.compile(r'\n\s*\n')       # 空行
+
+# PyMuPDF 非线程安全：进程内各线程（OCR 文件分类与文本提取、后台印章裁图、PaddleX 读取 PDF 输入）的 fitz 调用都在此锁内执行
+FITZ_LOCK = threading.RLock()
+
+_DONE = object()
+
+
+def normalize_ws(text):
+    """
+    空格类字符连续段统一为一个空格，\r\n、\r、\f 统一为 \n。
+    结果与 re.sub(r'[ \t\xa0]+', ' ') 后再 re.sub(r'\r\n|\r|\f', '\n') 一致；换行用 str.replace，不含时几乎零开销。
+    """
+    text = _RE_WS.sub(' ', text)
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('\f', '\n')
+
+
+def clean_page_text(text):
+    """统一空格与换行，去除多余空行"""
+    return _RE_BLANKLINES.sub('\n', normalize_ws(text))
+
+
+def _extract_doc_pages(doc, page_nums):
+    return {page_num + 1: clean_page_text(doc[page_num].get_text("text")) for page_num in page_nums}
+
+
+def fitz_locked(iterable):
+    """
+    逐个产出 iterable 的元素，每次取值时持有 FITZ_LOCK，两次取值之间释放。
+    用于包装 PaddleX predict 返回的惰性生成器：PDF 输入由 PaddleX 在取下一页时用 fitz 打开、渲染，
+    须与其他线程的 fitz 调用互斥；其他线程的 fitz 调用可在页与页之间穿插执行。
+    """
+    iterator = iter(iterable)
+    try:
+        while True:
+            with FITZ_LOCK:
+                item = next(iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            with FITZ_LOCK:  # 提前结束时关闭底层生成器，PaddleX 打开的文档在锁内释放
+                close()
+
+
+def read_pdf_pages(file_path):
+    """
+    提取 PDF 全部页的文本层，返回 {页码(从 1 开始): 文本}。
+    file_path 也可以是已打开的 fitz.Document：直接复用，不再重新打开（调用方负责关闭）。
+    调用方需持有 FITZ_LOCK。
+    """
+    if isinstance(file_path, fitz.Document):
+        return _extract_doc_pages(file_path, range(file_path.page_count))
+    with fitz.open(str(file_path)) as doc:
+        return _extract_doc_pages(doc, range(doc.page_count))
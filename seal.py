@@ -5,11 +5,19 @@ from pathlib import Path
 from typing import Any, Dict, List, Tuple
 import json
 import re
+import struct
+import functools
+import threading
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import fitz  # PyMuPDF
 from PIL import Image
 from paddlex import create_pipeline
 
+from module.pdf_text import FITZ_LOCK, fitz_locked
+
 
 BANK_KEYWORDS = [
     "银行", "商业银行", "农村商业银行", "信用社", "农信", "农商行", "农联社", "农村信用合作社"
@@ -25,6 +33,16 @@ BANK_NAME_REGEXES = [
     r"([^\s，。、“”]+信用社)",
 ]
 
+# 模块加载时编译一次；各正则独立匹配（同一段文字可同时命中多条，打分按命中条数累加），不合并为单个交替式
+_BANK_NAME_RXS = [re.compile(pat) for pat in BANK_NAME_REGEXES]
+# 只判断是否命中任一关键词：包含其他关键词的长词（如“商业银行”含“银行”）可去掉，交替分支更少
+_BANK_KW_RX = re.compile("|".join(
+    re.escape(k) for k in BANK_KEYWORDS if not any(o != k and o in k for o in BANK_KEYWORDS)
+))
+
+# 后台写盘任务的最大积压数，超过时等待最早的任务完成，限制内存中暂存的页面结果
+_MAX_PENDING_WRITES = 4
+
 def _jsonable(res: Any) -> Dict[str, Any]:
     try:
         if hasattr(res, "to_dict"):
@@ -32,15 +50,49 @@ def _jsonable(res: Any) -> Dict[str, Any]:
     except Exception:
         pass
     try:
-        return json.loads(json.dumps(res, default=lambda o: getattr(o, "__dict__", str(o))))
+        return _to_plain(res)
     except Exception:
         return {"_repr": str(res)}
 
+def _to_plain(o: Any) -> Any:
+    """
+    一次遍历转成纯 Python 结构，结果与 json.loads(json.dumps(o, default=...)) 相同，但不经过字符串。
+    无法 JSON 化的对象取 __dict__，没有则转为 str。
+    """
+    if o is None:
+        return None
+    if isinstance(o, str):
+        return str(o)
+    if isinstance(o, bool):
+        return bool(o)
+    if isinstance(o, int):
+        return int(o)
+    if isinstance(o, float):
+        return float(o)
+    if isinstance(o, dict):
+        return {_plain_key(k): _to_plain(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [_to_plain(v) for v in o]
+    d = getattr(o, "__dict__", None)
+    return str(o) if d is None else _to_plain(d)
+
+def _plain_key(k: Any) -> str:
+    """按 json.dumps 的规则转换字典键；不支持的键类型抛 TypeError"""
+    if isinstance(k, str):
+        return str(k)
+    if k is None or isinstance(k, (bool, int, float)):
+        return json.dumps(k)
+    raise TypeError(f"keys must be str, int, float, bool or None, not {type(k).__name__}")
+
 def _ensure_dir(p: Path) -> None:
     p.mkdir(parents=True, exist_ok=True)
 
+def _save_page_outputs(res: Any, out_dir: Path) -> None:
+    res.save_to_img((out_dir / "img").as_posix())
+    res.save_to_json((out_dir / "json").as_posix())
+
 def _is_bank_text(s: str) -> bool:
-    return s and any(k in s for k in BANK_KEYWORDS)
+    return s and _BANK_KW_RX.search(s) is not None
 
 def _score_bank_name(s: str) -> float:
     """简单的打分：长度 + 关键词命中数 + 正则命中加权"""
@@ -48,48 +100,64 @@ def _score_bank_name(s: str) -> float:
         return 0.0
     base = len(s) * 0.5
     kw = sum(1 for k in BANK_KEYWORDS if k in s) * 2.0
-    rx = 0.0
-    for pat in BANK_NAME_REGEXES:
-        if re.search(pat, s):
-            rx += 3.0
+    rx = sum(3.0 for rx_ in _BANK_NAME_RXS if rx_.search(s))
     return base + kw + rx
 
-def _extract_bank_name_candidates(text: str) -> List[Tuple[str, float]]:
+@functools.lru_cache(maxsize=1024)  # 同一印章常在每页重复出现，相同文本只解析一次
+def _extract_bank_name_candidates(text: str) -> Tuple[Tuple[str, float], ...]:
     text = (text or "").strip()
     cands: List[str] = []
-    for pat in BANK_NAME_REGEXES:
-        for m in re.finditer(pat, text):
-            cands.append(m.group(1))
+    for rx in _BANK_NAME_RXS:
+        cands.extend(m.group(1) for m in rx.finditer(text))
     # 如果正则一个都没抓到，退化：整段里带“银行/信用社”的也算候选
     if not cands and _is_bank_text(text):
         cands.append(text)
-    scored = [(t, _score_bank_name(t)) for t in cands]
-    # 去重保留最高分
+    # 去重保留最高分（同一候选分数相同，只需打分一次）
     best: Dict[str, float] = {}
-    for t, sc in scored:
-        best[t] = max(best.get(t, 0.0), sc)
-    return sorted(best.items(), key=lambda x: -x[1])
+    for t in cands:
+        if t not in best:
+            best[t] = max(0.0, _score_bank_name(t))
+    return tuple(sorted(best.items(), key=lambda x: -x[1]))
 
-def _render_pdf_page(pdf: Path, page_index: int, w: int, h: int) -> Image.Image:
-    """把 PDF 第 page_index(0-based) 页按像素 w*h 渲干净底图"""
-    doc = fitz.open(pdf.as_posix())
-    try:
-        page = doc[page_index]
-        mx = w / page.rect.width
-        my = h / page.rect.height
-        pm = page.get_pixmap(matrix=fitz.Matrix(mx, my), alpha=False)
-        return Image.frombytes("RGB", [pm.width, pm.height], pm.samples)
-    finally:
-        doc.close()
+def _page_pixel_size(doc: fitz.Document, page_index: int, dpi: int = 220) -> Tuple[int, int]:
+    """按 dpi 渲染时的像素尺寸，取整规则与 get_pixmap 相同，但不实际渲染"""
+    irect = (doc[page_index].rect * fitz.Matrix(dpi / 72.0, dpi / 72.0)).irect
+    return irect.width, irect.height
 
-def _crop(img: Image.Image, bbox: List[float], margin: int) -> Image.Image:
-    W, H = img.size
+def _png_size(p: Path) -> Tuple[int, int]:
+    """直接读 PNG 头部 IHDR 中的宽高，不经过 PIL；非 PNG 时回退到 Image.open（同样只读头部）"""
+    with open(p, "rb") as f:
+        head = f.read(24)
+    if len(head) == 24 and head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+        return struct.unpack(">II", head[16:24])
+    with Image.open(p) as img:
+        return img.size
+
+def _crop_box(W: int, H: int, bbox: List[float], margin: int) -> Tuple[int, int, int, int]:
     x1, y1, x2, y2 = bbox
     cx1 = max(0, int(round(x1)) - margin)
     cy1 = max(0, int(round(y1)) - margin)
     cx2 = min(W, int(round(x2)) + margin)
     cy2 = min(H, int(round(y2)) + margin)
-    return img.crop((cx1, cy1, cx2, cy2))
+    return cx1, cy1, cx2, cy2
+
+def _crop(img: Image.Image, bbox: List[float], margin: int) -> Image.Image:
+    W, H = img.size
+    return img.crop(_crop_box(W, H, bbox, margin))
+
+def _render_pdf_crop(doc: fitz.Document, page_index: int, w: int, h: int,
+                     bbox: List[float], margin: int) -> Image.Image:
+    """只渲染 bbox（w*h 底图像素坐标，加 margin）对应区域，等同于渲整页底图后 _crop，但不渲染整页"""
+    page = doc[page_index]
+    mx = w / page.rect.width
+    my = h / page.rect.height
+    cx1, cy1, cx2, cy2 = _crop_box(w, h, bbox, margin)
+    clip = fitz.Rect(cx1 / mx, cy1 / my, cx2 / mx, cy2 / my)
+    pm = page.get_pixmap(matrix=fitz.Matrix(mx, my), clip=clip, alpha=False)
+    # samples_mv 直接暴露 pixmap 缓冲区（pm.samples 会先多拷一份 bytes），frombytes 只复制一次
+    img = Image.frombytes("RGB", (pm.width, pm.height), pm.samples_mv)
+    pm = None  # frombytes 已复制像素，立即释放 MuPDF pixmap
+    return img
 
 
 class SealTool:
@@ -98,6 +166,8 @@ class SealTool:
     def __init__(self, margin: int = 8):
         self.pipeline = create_pipeline("Seal.yaml")
         self.margin = margin
+        # pipeline 由各任务线程共享，PaddleX predict 非线程安全，多任务并发时串行调用
+        self._predict_lock = threading.Lock()
 
     def _extract_page_info(self, res_dict: Dict[str, Any]) -> Dict[str, Any]:
         # layout seal框
@@ -144,81 +214,107 @@ class SealTool:
           "pages": {...}  # 每页明细，必要时可用
         }
         """
+        # predict 返回惰性生成器，逐页推理贯穿整个结果遍历，因此整份文件处理期间持有锁
+        with self._predict_lock:
+            return self._extract_from_file(input_path, out_dir)
+
+    def _extract_from_file(self, input_path: Path, out_dir: Path | None) -> Dict[str, Any]:
         input_path = Path(input_path).resolve()
         if out_dir:
             out_dir = Path(out_dir).resolve()
-            _ensure_dir(out_dir)
-            _ensure_dir(out_dir / "img")
-            _ensure_dir(out_dir / "json")
-            _ensure_dir(out_dir / "bank_seals")
-            _ensure_dir(out_dir / "raw_pages_cache")
-
-        # 只开 seal，避免“参数非法”情况
-        outputs = self.pipeline.predict(
+            for sub in ("img", "json", "bank_seals"):  # parents=True 时 out_dir 本身会一并创建
+                _ensure_dir(out_dir / sub)
+
+        # 只开 seal，避免“参数非法”情况；PDF 由 PaddleX 逐页用 fitz 读取，每取一页持有 FITZ_LOCK
+        outputs = fitz_locked(self.pipeline.predict(
             input_path.as_posix(),
             use_seal_recognition=True,
-        )
+        ))
 
         pages: Dict[str, Any] = {}
         bank_items: List[Dict[str, Any]] = []
-        global_candidates: Dict[str, float] = {}
+        global_candidates: Dict[str, float] = defaultdict(float)
 
         stem = input_path.stem
-        for idx, res in enumerate(outputs, 1):
-            # 保存原始可视化与json（可选）
-            if out_dir:
-                res.save_to_img((out_dir / "img").as_posix())
-                res.save_to_json((out_dir / "json").as_posix())
-
-            res_d = _jsonable(res)
-            page_idx = int(res_d.get("page_index") if res_d.get("page_index") is not None else idx)
-            info = self._extract_page_info(res_d)
-            pages[str(page_idx)] = info
-
-            # 按 parsing_res 的 seal 文本块来裁剪（位置稳定）
-            bank_blocks = [b for b in info["seal_blocks_text"] if _is_bank_text(b.get("text", ""))]
-
-            # 渲底图并裁切
-            layout_png = (out_dir / "img" / f"{stem}_{page_idx}_layout_det_res.png") if out_dir else None
-            if layout_png and layout_png.exists():
-                W, H = Image.open(layout_png).size
-            else:
-                with fitz.open(input_path.as_posix()) as tmpdoc:
-                    pg = tmpdoc[page_idx]
-                    pm = pg.get_pixmap(matrix=fitz.Matrix(220/72.0, 220/72.0), alpha=False)
-                    W, H = pm.width, pm.height
-            raw_cache = (out_dir / "raw_pages_cache" / f"{stem}_{page_idx}_raw.png") if out_dir else None
-            if raw_cache and not raw_cache.exists():
-                img = _render_pdf_page(input_path, page_idx, W, H)
-                img.save(raw_cache.as_posix())
-            raw_img = Image.open(raw_cache).convert("RGB") if raw_cache and raw_cache.exists() else None
-
-            for i, b in enumerate(bank_blocks, 1):
-                text = b.get("text", "")
-                bbox = b.get("bbox", [])
-                img_path = ""
-                if raw_img is not None and bbox:
-                    roi = _crop(raw_img, bbox, self.margin)
-                    out_p = (out_dir / "bank_seals" / f"p{page_idx:03d}_bank_{i:02d}.png") if out_dir else None
-                    if out_p:
-                        roi.save(out_p.as_posix())
-                        img_path = out_p.as_posix()
-
-                # 文本→候选银行名
-                for t, sc in _extract_bank_name_candidates(text):
-                    global_candidates[t] = max(global_candidates.get(t, 0.0), sc)
-
-                bank_items.append({
-                    "page_index": page_idx,
-                    "text": text,
-                    "bbox": bbox,
-                    "image": img_path
-                })
-
-            # 兜底：seal_ocr_texts 里也跑一遍候选
-            joined = "，".join(info["seal_ocr_texts"])
-            for t, sc in _extract_bank_name_candidates(joined):
-                global_candidates[t] = max(global_candidates.get(t, 0.0), sc)
+        pdf_doc = None  # 渲染/取尺寸时才打开，整份文件只打开一次
+        # 可视化图、json、seal 裁图的写盘交给单个后台线程，与下一页的模型推理重叠；
+        # fitz 渲染仍在当前线程执行，并持有 FITZ_LOCK（PyMuPDF 非线程安全，OCR 可能在其他线程同时使用 fitz）
+        writer = ThreadPoolExecutor(max_workers=1) if out_dir else None
+        pending = deque()
+
+        def submit_write(fn, *args):
+            future = writer.submit(fn, *args)
+            pending.append(future)
+            while len(pending) > _MAX_PENDING_WRITES:
+                pending.popleft().result()
+            return future
+
+        try:
+            for idx, res in enumerate(outputs, 1):
+                res_d = _jsonable(res)  # 先在当前线程转成 dict，再交给后台写盘，避免两个线程同时访问 res
+                # 保存原始可视化与json（可选）
+                page_saved = submit_write(_save_page_outputs, res, out_dir) if out_dir else None
+                page_idx = int(res_d.get("page_index") if res_d.get("page_index") is not None else idx)
+                info = self._extract_page_info(res_d)
+                pages[str(page_idx)] = info
+
+                # 按 parsing_res 的 seal 文本块来裁剪（位置稳定）
+                bank_blocks = [b for b in info["seal_blocks_text"] if _is_bank_text(b.get("text", ""))]
+
+                # 裁切 seal：按 seal 框直接从 PDF 渲染该区域，不渲染、不解码整页底图；没有银行章的页不打开 PDF
+                page_size = None  # 底图像素尺寸 (W, H)，bbox 即基于该坐标系
+                if out_dir and bank_blocks:
+                    if pdf_doc is None:
+                        with FITZ_LOCK:
+                            pdf_doc = fitz.open(input_path.as_posix())
+                    page_saved.result()  # 需要该页的可视化图确定底图尺寸
+                    layout_png = out_dir / "img" / f"{stem}_{page_idx}_layout_det_res.png"
+                    if layout_png.exists():
+                        page_size = _png_size(layout_png)
+                    else:
+                        with FITZ_LOCK:
+                            page_size = _page_pixel_size(pdf_doc, page_idx)
+
+                for i, b in enumerate(bank_blocks, 1):
+                    text = b.get("text", "")
+                    bbox = b.get("bbox", [])
+                    img_path = ""
+                    if page_size is not None and bbox:
+                        with FITZ_LOCK:
+                            roi = _render_pdf_crop(pdf_doc, page_idx, *page_size, bbox, self.margin)
+                        out_p = (out_dir / "bank_seals" / f"p{page_idx:03d}_bank_{i:02d}.png") if out_dir else None
+                        if out_p:
+                            submit_write(roi.save, out_p.as_posix())
+                            img_path = out_p.as_posix()
+
+                    # 文本→候选银行名
+                    for t, sc in _extract_bank_name_candidates(text):
+                        if sc > global_candidates[t]:
+                            global_candidates[t] = sc
+
+                    bank_items.append({
+                        "page_index": page_idx,
+                        "text": text,
+                        "bbox": bbox,
+                        "image": img_path
+                    })
+
+                # 兜底：seal_ocr_texts 里也跑一遍候选
+                joined = "，".join(info["seal_ocr_texts"])
+                for t, sc in _extract_bank_name_candidates(joined):
+                    if sc > global_candidates[t]:
+                        global_candidates[t] = sc
+
+            # 等待剩余写盘完成，写盘异常在此抛出
+            while pending:
+                pending.popleft().result()
+        finally:
+            if writer is not None:
+                writer.shutdown(wait=True)
+            if pdf_doc is not None:
+                with FITZ_LOCK:
+                    pdf_doc.close()
+                    fitz.TOOLS.store_shrink(100)  # 清空 MuPDF 资源缓存，避免常驻进程内存持续增长
 
         sorted_cands = sorted(global_candidates.items(), key=lambda x: -x[1])
         best_bank = sorted_cands[0][0] if sorted_cands else ""
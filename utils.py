@@ -1,12 +1,92 @@
 # module/utils.py
 import re
+import os
+import math
+import json
+import asyncio
+import time
+import random
+import hashlib
 import datetime
 import shutil
+import threading
 from pathlib import Path
+from collections import OrderedDict
 from collections.abc import Sequence
+from operator import mul
 
-import pandas as pd
 from cn2an import cn2an
+from loguru import logger
+try:
+    import orjson            # 可选依赖：pip install orjson，缺失时回退到标准库 json
+except ImportError:
+    orjson = None
+
+_SINK_NAMES = set()
+_SINK_LOCK = threading.Lock()
+
+# 日志保留天数与压缩格式，避免长期运行后日志无限增长
+LOG_RETENTION = "7 days"
+LOG_COMPRESSION = "gz"
+
+class DailySizeRotation:
+    """
+    loguru 的 rotation 回调：每天零点或文件超过 max_bytes 时切分。
+    文件大小在切换文件时用 fstat 取一次，之后累加消息的 UTF-8 字节数（中文约 3 字节/字），避免每条日志都查询文件位置。
+    每个 sink 需使用独立实例。
+    """
+    def __init__(self, max_bytes=100 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._file = None
+        self._size = 0
+        self._day = None
+
+    def __call__(self, message, file):
+        day = message.record["time"].date()
+        if file is not self._file:
+            self._file = file
+            self._size = os.fstat(file.fileno()).st_size
+            self._day = day
+        size = len(message) if message.isascii() else len(message.encode('utf-8'))
+        if day != self._day or self._size + size > self.max_bytes:
+            return True
+        self._size += size
+        return False
+
+def get_module_logger(log_name):
+    """
+    获取按模块分文件输出的 logger。
+    同名 sink 只注册一次，多次实例化客户端不会重复写日志；enqueue=True 使写文件不阻塞调用线程，
+    按块缓冲（而非逐行）写文件以减少系统调用。
+    """
+    with _SINK_LOCK:
+        if log_name not in _SINK_NAMES:
+            logger.add(f"logs/module_{log_name}_{{time:YYYY-MM-DD}}.log",
+                       level="INFO",
+                       rotation=DailySizeRotation(),
+                       retention=LOG_RETENTION,
+                       compression=LOG_COMPRESSION,
+                       filter=lambda record: record["extra"].get("name") == log_name,
+                       enqueue=True,
+                       buffering=65536)
+            _SINK_NAMES.add(log_name)
+    return logger.bind(name=log_name)
+
+def json_loads(s):
+    return orjson.loads(s) if orjson is not None else json.loads(s)
+
+def json_dumps(obj, indent=None) -> str:
+    """
+    序列化为 str，中文不转义。
+    指定 indent 时用标准库输出，与 json.dumps(..., indent=indent) 逐字节一致（orjson 只支持 2 格缩进）。
+    """
+    if orjson is not None and indent is None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, indent=indent)
+
+def is_missing(x):
+    """None 或 NaN 视为缺失值"""
+    return x is None or (isinstance(x, float) and math.isnan(x))
 
 def is_sequence(obj):
     return isinstance(obj, Sequence) and not isinstance(obj, (str, bytes))
@@ -14,71 +94,151 @@ def is_sequence(obj):
 def to_list(obj):
     return list(obj) if is_sequence(obj) else [obj]
 
+_RE_NUM_STRIP = re.compile(r'[_\s]')
+_RE_PLAIN_NUMBER = re.compile(r'-?[0-9]+(?:\.[0-9]+)?')
+
 def convert_to_number(x, fail_return=None):
     try:
-        if x == '' or pd.isna(x):
+        if x == '' or is_missing(x):
             return fail_return
-        x = cn2an(re.sub(r'[_\s]', '', str(x)), mode='smart')   # 中文数字转阿拉伯
+        x = _RE_NUM_STRIP.sub('', str(x))
+        if _RE_PLAIN_NUMBER.fullmatch(x):
+            x = float(x)   # 纯阿拉伯数字直接转换，结果与 cn2an smart 模式一致，省去 cn2an 的解析开销
+        else:
+            x = cn2an(x, mode='smart')   # 中文数字转阿拉伯
     except Exception:
         return fail_return
     return int(x) if x == int(x) else x
 
+# 支持的日期形态：YYYY-MM-DD / YYYY年MM月DD日 / YYYY年MM月，一次匹配后按分组名选择解析格式
+_RE_DATE = re.compile(r'(?P<iso>\d{4}-\d{1,2}-\d{1,2})|(?P<ymd>\d{4}年\d{1,2}月\d{1,2}日)|(?P<ym>\d{4}年\d{1,2}月)')
+# 分组名 -> (解析格式, 输出格式)
+_DATE_FORMATS = {
+    'iso': ('%Y-%m-%d', '%Y-%m-%d'),
+    'ymd': ('%Y年%m月%d日', '%Y-%m-%d'),
+    'ym': ('%Y年%m月', '%Y-%m'),
+}
+
 def convert_to_date(x, fail_return=None):
-    if x == '' or pd.isna(x):
+    if x == '' or is_missing(x):
         return fail_return
-    x = re.sub(r'[_\s]', '', str(x))
+    x = _RE_NUM_STRIP.sub('', str(x))
 
-    # YYYY-MM-DD
-    if re.search(r'^\d{4}-\d{1,2}-\d{1,2}$', x.strip()):
-        try:
-            d = datetime.datetime.strptime(x, '%Y-%m-%d')
-            return d.strftime('%Y-%m-%d')
-        except Exception:
-            return fail_return
+    m = _RE_DATE.fullmatch(x)
+    if m is None:
+        return fail_return
+    parse_fmt, out_fmt = _DATE_FORMATS[m.lastgroup]
+    try:
+        return datetime.datetime.strptime(x, parse_fmt).strftime(out_fmt)
+    except Exception:
+        return fail_return
 
-    # YYYY年MM月DD日
-    if '年' in x and '月' in x and '日' in x:
-        try:
-            d = datetime.datetime.strptime(x, '%Y年%m月%d日')
-            return d.strftime('%Y-%m-%d')
-        except Exception:
-            return fail_return
+# 18 位身份证号：不设分组，finditer 直接取 group()
+_RE_ID_NUMBER = re.compile(r'\b[1-9]\d{5}(?:19|20)\d{2}(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])\d{3}[\dXx]\b')
+_ID_WEIGHTS = (7, 9, 10, 5, 8, 4, 2, 1, 6, 3, 7, 9, 10, 5, 8, 4, 2)
+_ID_CHECK_CODES = '10X98765432'
+# ASCII 数字字节 -> 数值，一次 translate 代替 17 次 int()
+_ID_DIGIT_TABLE = bytes.maketrans(b'0123456789', bytes(range(10)))
 
-    # YYYY年MM月
-    if '年' in x and '月' in x:
+def _check_id_valid(id_num: str) -> bool:
+    if len(id_num) != 18:
+        return False
+    try:
+        digits = id_num[:17].encode('ascii').translate(_ID_DIGIT_TABLE)
+    except UnicodeEncodeError:
+        # \d 也匹配全角等 Unicode 数字，交给 int() 处理
         try:
-            d = datetime.datetime.strptime(x, '%Y年%m月')
-            return d.strftime('%Y-%m')
-        except Exception:
-            return fail_return
-
-    return fail_return
+            digits = list(map(int, id_num[:17]))
+        except ValueError:
+            return False
+    s = sum(map(mul, digits, _ID_WEIGHTS))
+    return id_num[-1] == _ID_CHECK_CODES[s % 11]
 
 def extract_valid_id_numbers(all_text: str):
     """
     提取并验证合法的18位身份证号（含末位X）。
     返回 dict: {id: "1"}
     """
-    id_pattern = r'\b([1-9]\d{5}(19|20)\d{2}(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])\d{3}[\dXx])\b'
-    raw_ids = re.findall(id_pattern, all_text or "")
-    id_numbers = list({g[0].upper() for g in raw_ids})
+    result = {}
+    for m in _RE_ID_NUMBER.finditer(all_text or ""):
+        i = m.group().upper()
+        if i not in result and _check_id_valid(i):
+            result[i] = "1"
+    return result
 
-    def check_id_valid(id_num: str) -> bool:
-        if len(id_num) != 18:
-            return False
-        weights = [7,9,10,5,8,4,2,1,6,3,7,9,10,5,8,4,2]
-        check_map = ['1','0','X','9','8','7','6','5','4','3','2']
-        try:
-            s = sum(int(n) * w for n, w in zip(id_num[:-1], weights))
-        except ValueError:
-            return False
-        return id_num[-1] == check_map[s % 11]
+def backoff_delay(attempt, base=3, cap=30):
+    """
+    指数退避 + 随机抖动，attempt 从 0 开始计数。
+    抖动可避免多个任务在同一时刻集中重试。
+    """
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+def sleep_backoff(attempt, base=3, cap=30):
+    time.sleep(backoff_delay(attempt, base, cap))
 
-    return {i: "1" for i in id_numbers if check_id_valid(i)}
+def is_retryable_status(status_code):
+    """4xx（429 除外）属于客户端错误，重试无意义"""
+    return status_code >= 500 or status_code == 429
+
+_ASYNC_LOOP = None
+_ASYNC_LOOP_LOCK = threading.Lock()
+
+def _get_async_loop() -> asyncio.AbstractEventLoop:
+    """惰性启动进程内唯一的后台事件循环线程"""
+    global _ASYNC_LOOP
+    with _ASYNC_LOOP_LOCK:
+        if _ASYNC_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='async-loop', daemon=True).start()
+            _ASYNC_LOOP = loop
+        return _ASYNC_LOOP
+
+def run_async(coro):
+    """
+    在进程共用的后台事件循环中执行协程，阻塞当前线程直到返回结果；可在任意任务线程调用（不可在该循环内调用）。
+    各任务不再各自 asyncio.run 新建循环，客户端里的 asyncio.Semaphore、异步连接池因此在整个进程内共用，
+    并发上限是进程级的，而不是每个任务各一份。
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_async_loop()).result()
+
+class LRUCache:
+    """线程安全的有界 LRU 缓存"""
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """对任意可 JSON 序列化的内容计算 sha256 作为缓存键"""
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
 
 def delete_path(path: Path):
-    try:
-        if path.exists():
-            shutil.rmtree(path)
-    except Exception:
-        pass
+    # 不存在时 rmtree 自行忽略，省去一次 exists() 的 stat
+    shutil.rmtree(path, ignore_errors=True)
+
+def clear_dir(path: Path):
+    """清空目录内容但保留目录本身"""
+    for child in path.iterdir():
+        if child.is_dir() and not child.is_symlink():
+            shutil.rmtree(child, ignore_errors=True)
+        else:
+            try:
+                child.unlink()
+            except Exception:
+                pass